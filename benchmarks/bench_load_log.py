@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Compare io.load_log with the fast parser against numpy.loadtxt
+
+usage: bench_load_log.py [n_rows]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy
+
+# run from a checkout without installing the package
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import blockpartyrfid
+
+
+def generate_log(fn, n, seed=0):
+    r = numpy.random.RandomState(seed)
+    tags = ['%010x' % t for t in r.randint(0, 2 ** 40, 20, dtype='int64')]
+    t = numpy.cumsum(r.randint(1, 500, n))
+    boards = r.randint(0, 8, n)
+    events = r.randint(0, 2, n)
+    with open(fn, 'w') as f:
+        for i in range(n):
+            if events[i] == 0:
+                d0, d1 = tags[r.randint(len(tags))], r.randint(0, 2)
+            else:
+                d0, d1 = 'LR'[r.randint(2)], 'ub'[r.randint(2)]
+            f.write('%i,%i,%i,%s,%s\n' % (t[i], boards[i], events[i], d0, d1))
+
+
+def timeit(f, *args, **kwargs):
+    t0 = time.time()
+    r = f(*args, **kwargs)
+    return time.time() - t0, r
+
+
+if __name__ == '__main__':
+    n = 200000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    with tempfile.TemporaryDirectory() as d:
+        fn = os.path.join(d, 'log.csv')
+        generate_log(fn, n)
+        st, s = timeit(blockpartyrfid.io.load_log, fn, fast=False)
+        ft, f = timeit(blockpartyrfid.io.load_log, fn, fast=True)
+    assert numpy.array_equal(s, f)
+    print("rows: %i" % n)
+    print("loadtxt: %.3f s" % st)
+    print("fast:    %.3f s (%.1fx)" % (ft, st / ft))
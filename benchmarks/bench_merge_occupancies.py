@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""Time occupancy.merge_occupancies (with culling) on synthetic occupancy
+
+usage: bench_merge_occupancies.py [n_animals] [rows_per_animal]
+"""
+
+import os
+import sys
+import time
+
+import numpy
+
+# run from a checkout without installing the package
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import blockpartyrfid
+
+
+def generate_occupancies(n_animals, n, duplicates=0.1, seed=0):
+    """per-animal occupancy with some duplicated (conflicting) rows"""
+    r = numpy.random.RandomState(seed)
+    occupancies = []
+    for a in range(n_animals):
+        t = numpy.cumsum(r.randint(1, 10000, n + 1))
+        o = numpy.column_stack([
+            t[:-1], t[1:], r.randint(0, 4, n), numpy.full(n, a),
+            r.randint(-10, 10, n)])
+        occupancies.append(o)
+        occupancies.append(o[r.rand(n) < duplicates])
+    return occupancies
+
+
+if __name__ == '__main__':
+    n_animals = 16
+    n = 100000
+    if len(sys.argv) > 1:
+        n_animals = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n = int(sys.argv[2])
+    occupancies = generate_occupancies(n_animals, n)
+    n_rows = sum(len(o) for o in occupancies)
+    for cull in (False, True):
+        t0 = time.time()
+        o = blockpartyrfid.occupancy.merge_occupancies(occupancies, cull=cull)
+        t = time.time() - t0
+        print("cull=%s: %i -> %i rows in %.3f s" % (cull, n_rows, len(o), t))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""Time vis.plot_occupancy, plot_occupancy2 and plot_occupancy3 (plot and
+draw with the Agg backend) for increasing numbers of occupancy rows
+
+usage: bench_plot_occupancy.py [max_rows] [n_animals]
+"""
+
+import os
+import sys
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy
+import pylab
+
+# run from a checkout without installing the package
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import blockpartyrfid.vis
+
+
+def generate_occupancy(n_animals, n, n_cages=4, seed=0):
+    """[enter, exit, cage, animal, direction] for n rows split over animals"""
+    r = numpy.random.RandomState(seed)
+    na = n // n_animals
+    os = []
+    for a in range(n_animals):
+        t = numpy.cumsum(r.randint(1, 10000, na + 1))
+        os.append(numpy.column_stack([
+            t[:-1], t[1:], r.randint(0, n_cages, na), numpy.full(na, a),
+            numpy.zeros(na, dtype='int64')]))
+    o = numpy.vstack(os)
+    return o[numpy.argsort(o[:, 0], kind='stable')]
+
+
+if __name__ == '__main__':
+    max_rows = 1000000
+    n_animals = 16
+    if len(sys.argv) > 1:
+        max_rows = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n_animals = int(sys.argv[2])
+    n = 1000
+    while n <= max_rows:
+        o = generate_occupancy(n_animals, n)
+        ts = []
+        for f in (
+                blockpartyrfid.vis.plot_occupancy,
+                blockpartyrfid.vis.plot_occupancy2,
+                blockpartyrfid.vis.plot_occupancy3):
+            fig = pylab.figure()
+            t0 = time.time()
+            f(o)
+            fig.canvas.draw()
+            ts.append(time.time() - t0)
+            pylab.close(fig)
+        print(
+            "%8i rows: plot_occupancy %.3f s, plot_occupancy2 %.3f s, "
+            "plot_occupancy3 %.3f s" % ((len(o), ) + tuple(ts)))
+        n *= 10
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import numpy
+
 # event types
 EVENT_RFID = 0
 EVENT_BEAM = 1
@@ -21,6 +23,20 @@ EVENT_COLUMN = 2
 DATA0_COLUMN = 3
 DATA1_COLUMN = 4
 
+# compact (structured) event layout, field i holds column i
+# data1 is wide enough for raw touch values
+column_names = ['time', 'board', 'event', 'data0', 'data1']
+compact_event_dtype = numpy.dtype([
+    ('time', 'int64'),
+    ('board', 'uint8'),
+    ('event', 'uint8'),
+    ('data0', 'int64'),
+    ('data1', 'int32'),
+])
+
+# index returned by batched event queries when no event was found
+NO_EVENT = -1
+
 # rfid columns
 RFID_ID_COLUMN = 3
 RFID_ERROR_COLUMN = 4
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import functools
+import multiprocessing
 import os
 import sys
 
@@ -14,29 +16,160 @@ if sys.version_info.major > 2:
 
 
 
-def sel(vs, board=None, event=None, data0=None, data1=None, timerange=None):
+def is_compact(vs):
+    return vs.dtype.names is not None
+
+
+def column(vs, c):
+    """Get column c (see consts *_COLUMN) of a (n, 5) or compact event array"""
+    if vs.dtype.names is not None:
+        return vs[consts.column_names[c]]
+    return vs[:, c]
+
+
+def to_compact(vs):
+    """Convert (n, 5) events to consts.compact_event_dtype"""
+    if is_compact(vs):
+        return vs
+    cvs = numpy.empty(vs.shape[0], dtype=consts.compact_event_dtype)
+    for (c, name) in enumerate(consts.column_names):
+        ft = cvs.dtype[name]
+        v = vs[:, c]
+        if len(v) and (
+                v.min() < numpy.iinfo(ft).min or
+                v.max() > numpy.iinfo(ft).max):
+            raise ValueError("%s values do not fit in %s" % (name, ft))
+        cvs[name] = v
+    return cvs
+
+
+def from_compact(cvs):
+    """Convert compact events back to an (n, 5) int64 array"""
+    if not is_compact(cvs):
+        return cvs
+    vs = numpy.empty((cvs.shape[0], 5), dtype='int64')
+    for (c, name) in enumerate(consts.column_names):
+        vs[:, c] = cvs[name]
+    return vs
+
+
+def _parse_sel_args(event, data0, data1):
     if isinstance(event, (str, unicode)):
         event = consts.event_strings[event]
     if isinstance(data0, (str, unicode)):
         data0 = consts.data_strings[event][0][data0]
     if isinstance(data1, (str, unicode)):
         data1 = consts.data_strings[event][1][data1]
+    return event, data0, data1
+
+
+def sel(vs, board=None, event=None, data0=None, data1=None, timerange=None):
+    if isinstance(vs, EventIndex):
+        return vs.sel(
+            board=board, event=event, data0=data0, data1=data1,
+            timerange=timerange)
+    event, data0, data1 = _parse_sel_args(event, data0, data1)
     m = numpy.ones(vs.shape[0], dtype='bool')
     if board is not None:
-        m &= (vs[:, consts.BOARD_COLUMN] == board)
+        m &= (column(vs, consts.BOARD_COLUMN) == board)
     if event is not None:
-        m &= (vs[:, consts.EVENT_COLUMN] == event)
+        m &= (column(vs, consts.EVENT_COLUMN) == event)
     if data0 is not None:
-        m &= (vs[:, consts.DATA0_COLUMN] == data0)
+        m &= (column(vs, consts.DATA0_COLUMN) == data0)
     if data1 is not None:
-        m &= (vs[:, consts.DATA1_COLUMN] == data1)
+        m &= (column(vs, consts.DATA1_COLUMN) == data1)
     if timerange is not None:
         assert len(timerange) == 2
-        m &= (vs[:, consts.TIME_COLUMN] < timerange[1])
-        m &= (vs[:, consts.TIME_COLUMN] > timerange[0])
+        t = column(vs, consts.TIME_COLUMN)
+        m &= (t < timerange[1])
+        m &= (t > timerange[0])
     return vs[m]
 
 
+class EventIndex(object):
+    """Index of an event array for repeated selections
+
+    Rows are grouped by (board, event, data0, data1) and sorted by time
+    within each group so sel becomes a lookup of matching groups plus a
+    binary search per group for timerange. Selections return the same
+    rows (in the same order) as sel on the indexed array or, with
+    by_time=True, sorted by time (stable, without a sort if only one
+    group matches).
+    """
+    key_columns = (
+        consts.BOARD_COLUMN, consts.EVENT_COLUMN,
+        consts.DATA0_COLUMN, consts.DATA1_COLUMN)
+
+    def __init__(self, vs):
+        self.events = vs
+        t = column(vs, consts.TIME_COLUMN)
+        keys = [column(vs, c) for c in self.key_columns]
+        # sort by board, event, data0, data1 then time
+        self.order = numpy.lexsort([t, ] + keys[::-1])
+        self.times = t[self.order]
+        skeys = numpy.column_stack(keys)[self.order]
+        if len(skeys):
+            m = numpy.any(skeys[1:] != skeys[:-1], axis=1)
+            self.starts = numpy.concatenate(([0, ], numpy.where(m)[0] + 1))
+        else:
+            self.starts = numpy.zeros(0, dtype='int64')
+        self.ends = numpy.append(self.starts[1:], len(skeys))
+        # (board, event, data0, data1) for each group
+        self.keys = skeys[self.starts]
+
+    def __len__(self):
+        return len(self.order)
+
+    def sel(
+            self, board=None, event=None, data0=None, data1=None,
+            timerange=None, by_time=False):
+        event, data0, data1 = _parse_sel_args(event, data0, data1)
+        gm = numpy.ones(len(self.keys), dtype='bool')
+        for (i, v) in enumerate((board, event, data0, data1)):
+            if v is not None:
+                gm &= self.keys[:, i] == v
+        starts = self.starts[gm]
+        ends = self.ends[gm]
+        if timerange is not None:
+            assert len(timerange) == 2
+            for (i, (s, e)) in enumerate(zip(starts, ends)):
+                ts = self.times[s:e]
+                starts[i] = s + numpy.searchsorted(
+                    ts, timerange[0], side='right')
+                ends[i] = s + numpy.searchsorted(
+                    ts, timerange[1], side='left')
+        inds = [self.order[s:e] for (s, e) in zip(starts, ends) if e > s]
+        if len(inds) == 0:
+            return self.events[:0]
+        if by_time and len(inds) == 1:
+            # groups are already sorted by time
+            return self.events[inds[0]]
+        # return in the original order
+        inds = numpy.sort(numpy.concatenate(inds))
+        if by_time:
+            inds = inds[numpy.argsort(
+                column(self.events, consts.TIME_COLUMN)[inds], kind='stable')]
+        return self.events[inds]
+
+
+def iter_sel(chunks, **kwargs):
+    """sel applied to each of a stream of event chunks"""
+    for vs in chunks:
+        vs = sel(vs, **kwargs)
+        if len(vs):
+            yield vs
+
+
+def concatenate(chunks):
+    """Combine a stream of event chunks into one array"""
+    chunks = list(chunks)
+    if len(chunks) == 0:
+        return numpy.empty((0, 5), dtype='int64')
+    if is_compact(chunks[0]):
+        return numpy.concatenate(chunks)
+    return numpy.vstack(chunks)
+
+
 def remap_ids(evs, rmap):
     # rmap: {old key: new key...}
     for k in rmap:
@@ -57,49 +190,92 @@ def _reduce_dict(d):
     raise TypeError("Cannot reduce type: %s" % type(d))
 
 
-def split_events(vs, board=True, event=True, data0=True, data1=True):
-    svs = {}
-    if board:
-        bids = all_boards(vs)
+def split_events(
+        vs, board=True, event=True, data0=True, data1=True, copy=True):
+    """Split events into nested dicts of [board][event][data0][data1]
+    levels that are not split (False) are removed from the result
+
+    Events are sorted once by all split columns (stable, so each split
+    keeps the original row order). If copy is False, splits are views
+    into this single sorted buffer."""
+    flags = (board, event, data0, data1)
+    n = vs.shape[0]
+    keys = [
+        column(vs, c) if f else None
+        for (c, f) in zip(EventIndex.key_columns, flags)]
+    used = [k for k in keys if k is not None]
+    if len(used):
+        order = numpy.lexsort(used[::-1])
     else:
-        bids = [None, ]
-    if event:
-        evs = numpy.unique(vs[:, consts.EVENT_COLUMN])
+        order = numpy.arange(n)
+    svs = vs[order]
+    skeys = [None if k is None else k[order] for k in keys]
+
+    # find groups of rows with identical keys
+    m = numpy.zeros(max(n - 1, 0), dtype='bool')
+    for k in skeys:
+        if k is not None:
+            m |= k[1:] != k[:-1]
+    if n:
+        starts = numpy.concatenate(([0, ], numpy.where(m)[0] + 1))
     else:
-        evs = [None, ]
-    for bid in bids:
-        svs[bid] = {}
-        for ev in evs:
-            d = sel(vs, board=bid, event=ev)
-            if data0:
-                d0s = numpy.unique(d[:, consts.DATA0_COLUMN])
-            else:
-                d0s = [None, ]
-            if data1:
-                d1s = numpy.unique(d[:, consts.DATA1_COLUMN])
-            else:
-                d1s = [None, ]
-            svs[bid][ev] = {}
-            for d0 in d0s:
-                svs[bid][ev][d0] = {}
+        starts = numpy.zeros(0, dtype='int64')
+    ends = numpy.append(starts[1:], n)
+    gkeys = [None if k is None else k[starts] for k in skeys]
+
+    def gkey(level, gi):
+        if gkeys[level] is None:
+            return None
+        return gkeys[level][gi]
+
+    def levels(level, gis):
+        if gkeys[level] is None:
+            return [None, ]
+        return numpy.unique(gkeys[level][gis])
+
+    # group indices for each (board, event)
+    be = {}
+    for gi in range(len(starts)):
+        be.setdefault((gkey(0, gi), gkey(1, gi)), []).append(gi)
+
+    svd = {}
+    all_gis = numpy.arange(len(starts))
+    for bid in levels(0, all_gis):
+        svd[bid] = {}
+        for ev in levels(1, all_gis):
+            gis = numpy.array(be.get((bid, ev), []), dtype='int64')
+            gd = {(gkey(2, gi), gkey(3, gi)): gi for gi in gis}
+            svd[bid][ev] = {}
+            # every data0 x data1 combination seen for this board & event
+            d1s = levels(3, gis)
+            for d0 in levels(2, gis):
+                svd[bid][ev][d0] = {}
                 for d1 in d1s:
-                    svs[bid][ev][d0][d1] = sel(d, data0=d0, data1=d1)
+                    gi = gd.get((d0, d1))
+                    if gi is None:
+                        d = svs[:0]
+                    else:
+                        d = svs[starts[gi]:ends[gi]]
+                    if copy:
+                        d = d.copy()
+                    svd[bid][ev][d0][d1] = d
     # re-combine
-    return _reduce_dict(svs)
+    return _reduce_dict(svd)
 
 
 def all_boards(vs):
-    return numpy.unique(vs[:, consts.BOARD_COLUMN])
+    return numpy.unique(column(vs, consts.BOARD_COLUMN))
 
 
 def all_animals(vs):
     return numpy.unique(
-        sel(vs, event='rfid', data1=0)[:, consts.RFID_ID_COLUMN])
+        column(sel(vs, event='rfid', data1=0), consts.RFID_ID_COLUMN))
 
 
 def by_animal(events):
     aids = all_animals(events)
-    return {aid: sel(events, event='rfid', data0=aid) for aid in aids}
+    index = EventIndex(sel(events, event='rfid'))
+    return {aid: index.sel(data0=aid) for aid in aids}
 
 
 def find_adjacent(a, b, return_mask=False):
@@ -160,26 +336,142 @@ def closest_event(evs, t, max_dt=None):
 
 def next_event(evs, t, max_dt=None):
     dts = evs[:, consts.TIME_COLUMN] - t
-    dts[dts < 0] = dts.max()
-    i = dts.argmin()
+    later = numpy.flatnonzero(dts >= 0)
+    if not len(later):
+        return None
+    i = later[dts[later].argmin()]
     if max_dt is not None and dts[i] > max_dt:
         return None
     return evs[i]
 
 
+def adjacent_event_indices(evs, ts):
+    """for each time in ts, find the last event in evs at or before it and
+    the first event in evs at or after it (evs must be sorted by time)
+    return [previous_index, next_index] with consts.NO_EVENT if no event
+    was found"""
+    t = column(evs, consts.TIME_COLUMN)
+    ts = numpy.asarray(ts)
+    pinds = numpy.searchsorted(t, ts, side='right') - 1
+    ninds = numpy.searchsorted(t, ts, side='left')
+    pinds = numpy.where(pinds < 0, consts.NO_EVENT, pinds)
+    ninds = numpy.where(ninds == len(t), consts.NO_EVENT, ninds)
+    return pinds, ninds
+
+
+def _event_dts(evs, inds, ts):
+    # absolute time difference to evs[inds] (inf for NO_EVENT)
+    t = column(evs, consts.TIME_COLUMN)
+    if len(t) == 0:
+        return numpy.full(inds.shape, numpy.inf)
+    return numpy.where(
+        inds == consts.NO_EVENT, numpy.inf, numpy.abs(t[inds] - ts))
+
+
+def _limit_dts(evs, inds, ts, max_dt):
+    if max_dt is not None:
+        inds = numpy.where(
+            _event_dts(evs, inds, ts) > max_dt, consts.NO_EVENT, inds)
+    return inds
+
+
+def previous_events(evs, ts, max_dt=None):
+    """Batched query of the last event at or before each time in ts
+    (evs must be sorted by time), returns indices into evs with
+    consts.NO_EVENT where there is none (or it is more than max_dt away)"""
+    pinds, _ = adjacent_event_indices(evs, ts)
+    return _limit_dts(evs, pinds, ts, max_dt)
+
+
+def next_events(evs, ts, max_dt=None):
+    """Batched next_event: indices of the first event at or after each
+    time in ts (see previous_events)"""
+    _, ninds = adjacent_event_indices(evs, ts)
+    return _limit_dts(evs, ninds, ts, max_dt)
+
+
+def closest_events(evs, ts, max_dt=None):
+    """Batched closest_event: indices of the closest event to each time in
+    ts, the earlier event on ties (see previous_events)"""
+    pinds, ninds = adjacent_event_indices(evs, ts)
+    inds = numpy.where(
+        _event_dts(evs, pinds, ts) <= _event_dts(evs, ninds, ts),
+        pinds, ninds)
+    return _limit_dts(evs, inds, ts, max_dt)
+
+
 def sum_range(a):
     """ sum ranges [column 0 = start_time, column 1 = end_time]
     without double counting overlaps"""
-    s = 0
     if len(a) == 0:
-        return s
-    for i in range(len(a) - 1):
-        if a[i, 1] > a[i + 1, 0]:
-            s += a[i + 1, 0] - a[i, 0]
-        else:
-            s += a[i, 1] - a[i, 0]
-    s += a[-1, 1] - a[-1, 0]
-    return s
+        return 0
+    return sum_ranges(a, numpy.zeros(len(a), dtype='int64'), 1)[0]
+
+
+def grouped_running_max(v, first):
+    """Running maximum of v that restarts at every True in first
+    (first marks the first element of each contiguous group)"""
+    if len(v) == 0:
+        return v.copy()
+    # offset each group past the previous ones so a single running
+    # maximum never carries over between groups
+    v0 = v.min()
+    offsets = (numpy.cumsum(first) - 1) * (v.max() - v0 + 1) - v0
+    return numpy.maximum.accumulate(v + offsets) - offsets
+
+
+def sum_ranges(a, groups, n_groups):
+    """ sum ranges [column 0 = start_time, column 1 = end_time]
+    for each group (groups: ints in [0, n_groups)) without double
+    counting overlaps
+
+    Ranges are sorted once by (group, start) and the covered time of each
+    range is what extends past the running maximum end of the earlier
+    ranges in its group."""
+    a = numpy.asarray(a)
+    totals = numpy.zeros(n_groups, dtype=a.dtype)
+    if len(a) == 0:
+        return totals
+    groups = numpy.asarray(groups)
+    order = numpy.lexsort((a[:, 0], groups))
+    g = groups[order]
+    s = a[order, 0]
+    e = a[order, 1]
+    first = numpy.ones(len(g), dtype='bool')
+    first[1:] = g[1:] != g[:-1]
+    prev = numpy.empty_like(e)
+    prev[1:] = grouped_running_max(e, first)[:-1]
+    prev[first] = s[first]
+    numpy.add.at(
+        totals, g, numpy.maximum(e - numpy.maximum(s, prev), 0))
+    return totals
+
+
+def time_in_cage(occupancy, animals=None, n_cages=None):
+    """Total (non-overlapping) time each animal spent in each cage
+    returns an (animal x cage) array of durations and the animal ids
+    (rows), animals default to all animals in occupancy (sorted) and
+    n_cages to the largest cage number + 1"""
+    if animals is None:
+        aids = numpy.unique(occupancy[:, 3])
+    else:
+        aids = numpy.asarray(animals)
+    if n_cages is None:
+        n_cages = (
+            int(numpy.max(occupancy[:, 2])) + 1 if len(occupancy) else 0)
+    if not len(occupancy) or not len(aids):
+        return numpy.zeros((len(aids), n_cages)), aids
+    # index of each row's animal & cage
+    sorter = numpy.argsort(aids)
+    ai = numpy.searchsorted(aids, occupancy[:, 3], sorter=sorter)
+    ai = sorter[numpy.minimum(ai, len(aids) - 1)]
+    ci = occupancy[:, 2].astype('int64')
+    m = (
+        (aids[ai] == occupancy[:, 3]) &
+        (ci >= 0) & (ci < n_cages))
+    totals = sum_ranges(
+        occupancy[m, :2], ai[m] * n_cages + ci[m], len(aids) * n_cages)
+    return totals.reshape(len(aids), n_cages), aids
 
 
 def beam_events_to_duration(be, min_duration=None):
@@ -215,21 +507,43 @@ def rfid_events_to_duration(re, min_duration=None):
     return d[:, :4]
 
 
-def find_overlapping_durations(a, b, margin=None):
+def find_overlaps(a, b, margin=None):
+    """Find all pairs of overlapping durations [column 0 = start, 1 = end]
+    a durations are extended by margin [before, after]
+    returns (a index, b index) arrays sorted by a index then b index
+
+    b is sorted by start so the candidates for each a are a range that
+    ends at the last b starting before a ends and begins at the first b
+    whose running maximum end reaches the start of a. For non-nested b
+    (sequential beam breaks etc) every candidate overlaps."""
     if margin is None:
         margin = [0, 0]
-    inds = []
-    for ai in xrange(len(a)):
-        sa = a[ai]
-        st = sa[0] - margin[0]
-        et = sa[1] + margin[1]
-        i = numpy.where(
-            numpy.logical_not((b[:, 0] > et) | (b[:, 1] < st)))[0]
-        #i = numpy.where(
-        #    ((b[:, 0] < st) & (b[:, 1] > st)) |
-        #    ((b[:, 0] < et) & (b[:, 1] > et)))[0]
-        inds.append(list(i))
-    return inds
+    st = a[:, 0] - margin[0]
+    et = a[:, 1] + margin[1]
+    order = numpy.argsort(b[:, 0], kind='stable')
+    bs = b[order, 0]
+    mbe = numpy.maximum.accumulate(b[order, 1])
+    k = numpy.searchsorted(bs, et, side='right')
+    j = numpy.minimum(numpy.searchsorted(mbe, st, side='left'), k)
+    counts = k - j
+    ai = numpy.repeat(numpy.arange(len(a)), counts)
+    offsets = numpy.cumsum(counts) - counts
+    bi = order[
+        numpy.arange(counts.sum()) + numpy.repeat(j - offsets, counts)]
+    # remove nested b that end before a starts
+    m = b[bi, 1] >= st[ai]
+    ai, bi = ai[m], bi[m]
+    o = numpy.lexsort((bi, ai))
+    return ai[o], bi[o]
+
+
+def find_overlapping_durations(a, b, margin=None):
+    """for each duration in a, list the indices of overlapping b durations"""
+    if len(a) == 0:
+        return []
+    ai, bi = find_overlaps(a, b, margin)
+    splits = numpy.searchsorted(ai, numpy.arange(1, len(a)))
+    return [list(i) for i in numpy.split(bi, splits)]
 
 
 def find_neighbors(index, key, omap, inds=None, visited=None):
@@ -270,6 +584,95 @@ def generate_overlap_map(le, re, ie, margin=None):
     }
 
 
+def generate_overlap_edges(le, re, ie, margin=None):
+    """Overlaps between left (le), right (re) and rfid (ie) durations
+    as directed edges (u, v) of a graph with nodes numbered: le, then re,
+    then ie (as generate_overlap_map, margins extend the u durations so
+    the edges are only symmetric for symmetric margins)"""
+    nl, nr = len(le), len(re)
+    us, vs = [], []
+    for (a, ao, b, bo, m) in (
+            (le, 0, re, nl, None),
+            (re, nl, le, 0, None),
+            (le, 0, ie, nl + nr, margin),
+            (re, nl, ie, nl + nr, margin),
+            (ie, nl + nr, le, 0, margin),
+            (ie, nl + nr, re, nl, margin)):
+        ai, bi = find_overlaps(a, b, m)
+        us.append(ai + ao)
+        vs.append(bi + bo)
+    return numpy.concatenate(us), numpy.concatenate(vs)
+
+
+def connected_components(n, u, v):
+    """Label the connected components of a graph with n nodes and edges
+    (u, v) using iterative hooking and pointer jumping (no recursion)
+    returns for each node the smallest node index in its component"""
+    labels = numpy.arange(n)
+    while True:
+        lu, lv = labels[u], labels[v]
+        m = numpy.minimum(lu, lv)
+        # hook roots to the smaller root
+        new = labels.copy()
+        numpy.minimum.at(new, lu, m)
+        numpy.minimum.at(new, lv, m)
+        # point every node at its root
+        while True:
+            jumped = new[new]
+            if numpy.array_equal(jumped, new):
+                break
+            new = jumped
+        if numpy.array_equal(new, labels):
+            return labels
+        labels = new
+
+
+def reachable_groups(n, u, v, starts):
+    """Walk the directed graph with n nodes and edges (u, v) from each start
+    that was not reached from an earlier start (as find_neighbors)
+    returns the (sorted) nodes reached from each walked start"""
+    order = numpy.argsort(u, kind='stable')
+    targets = v[order]
+    indptr = numpy.searchsorted(u[order], numpy.arange(n + 1))
+    reached = numpy.zeros(n, dtype='bool')
+    # nodes seen by the current walk are marked with the walk number
+    seen = numpy.full(n, -1, dtype='int64')
+    groups = []
+    for start in starts:
+        if reached[start]:
+            continue
+        walk = len(groups)
+        seen[start] = walk
+        nodes = [start]
+        stack = [start]
+        while stack:
+            node = stack.pop()
+            for o in targets[indptr[node]:indptr[node + 1]]:
+                if seen[o] != walk:
+                    seen[o] = walk
+                    nodes.append(o)
+                    stack.append(o)
+        nodes = numpy.sort(numpy.array(nodes, dtype='int64'))
+        reached[nodes] = True
+        groups.append(nodes)
+    return groups
+
+
+def component_groups(n, u, v, starts):
+    """Connected components (edges treated as undirected) of a graph with
+    n nodes and edges (u, v) that contain a start, in order of their
+    first start. returns the (sorted) nodes of each component"""
+    labels = connected_components(n, u, v)
+    order = numpy.argsort(labels, kind='stable')
+    slabels = labels[order]
+    clabels, first = numpy.unique(
+        labels[starts], return_index=True)
+    clabels = clabels[numpy.argsort(first)]
+    cstarts = numpy.searchsorted(slabels, clabels, side='left')
+    cends = numpy.searchsorted(slabels, clabels, side='right')
+    return [order[cs:ce] for (cs, ce) in zip(cstarts, cends)]
+
+
 def find_tube_events(
         board_events, margin=None, min_duration=None,
         ignore_tails=True, remove_conflicts=True):
@@ -285,32 +688,32 @@ def find_tube_events(
     ie = rfid_events_to_duration(
         sel(board_events, event='rfid'))
     ed = {'l': lbe, 'r': rbe, 'i': ie}
-    # find overlapping beam durations
-    omap = generate_overlap_map(lbe, rbe, ie, margin)
-    # merge beam durations
+    # find overlapping durations (as a graph of l, r then i nodes)
+    nl, nr = len(lbe), len(rbe)
+    n = nl + nr + len(ie)
+    u, v = generate_overlap_edges(lbe, rbe, ie, margin)
+    # group nodes reachable from each right beam duration
+    starts = numpy.arange(nl, nl + nr)
+    if margin is None or margin[0] == margin[1]:
+        # overlaps are symmetric so groups are connected components
+        groups = component_groups(n, u, v, starts)
+    else:
+        # a duration can be reached from more than one right duration
+        groups = reachable_groups(n, u, v, starts)
     tube_events = []
-    visited = set()
-    for ri in xrange(len(rbe)):
-        if ri in visited:
-            continue
-        # for each index in right, find 'neighbors'
-        inds = find_neighbors(ri, 'r', omap)
-        inds['r'].append(ri)
-        for k in inds:
-            inds[k].sort()
-        [visited.add(ri) for ri in inds['r']]
+    for nodes in groups:
+        inds = {
+            'l': nodes[nodes < nl],
+            'r': nodes[(nodes >= nl) & (nodes < nl + nr)] - nl,
+            'i': nodes[nodes >= nl + nr] - (nl + nr),
+        }
 
         if len(inds['l']) == 0:
             continue
 
         # find start/end times
-        st = ed['r'][ri][0]
-        et = ed['r'][ri][1]
-        for k in inds:
-            for i in inds[k]:
-                d = ed[k][i]
-                st = min(st, d[0])
-                et = max(et, d[1])
+        st = min(ed[k][inds[k], 0].min() for k in inds if len(inds[k]))
+        et = max(ed[k][inds[k], 1].max() for k in inds if len(inds[k]))
         direction = '?'
         if len(inds['l']) == 1 and len(inds['r']) == 1:
             l = ed['l'][inds['l'][0]][0]
@@ -325,11 +728,11 @@ def find_tube_events(
             'end': et,
             'board': board,
             'duration': duration,
-            'animals': set([ed['i'][i][3] for i in inds['i']]),
+            'animals': set(ed['i'][inds['i'], 3]),
             'direction': direction,
         }
         for k in 'lri':
-            te[k] = numpy.array([ed[k][i] for i in inds[k]])
+            te[k] = ed[k][inds[k]]
         if len(te['animals']) == 0:
             continue
         tube_events.append(te)
@@ -340,6 +743,34 @@ def find_tube_events(
     return tube_events
 
 
+def _board_tube_events(board_events, heuristics=True, **kwargs):
+    te = find_tube_events(board_events, **kwargs)
+    if heuristics:
+        apply_heuristics(te)
+    return te
+
+
+def find_all_tube_events(events, n_workers=None, heuristics=True, **kwargs):
+    """find_tube_events (and apply_heuristics) for every board
+    if n_workers is > 1, boards are processed in a pool of n_workers
+    processes. kwargs are passed on to find_tube_events
+    returns tube events from all boards sorted by start time"""
+    bevs = split_events(events, event=False, data0=False, data1=False)
+    bevs = [bevs[bid] for bid in sorted(bevs)]
+    f = functools.partial(_board_tube_events, heuristics=heuristics, **kwargs)
+    if n_workers is not None and n_workers > 1 and len(bevs) > 1:
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            tes = pool.map(f, bevs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        tes = [f(bev) for bev in bevs]
+    te = [e for bte in tes for e in bte]
+    return sorted(te, key=lambda e: e['start'])
+
+
 def unassign_conflicting_tube_event_directions(te):
     state = {}
     cs = []
@@ -577,3 +1008,18 @@ def merge_close_reads(reads, threshold=1000):
     m[1:] = numpy.diff(reads[:, 0]) > threshold
     m[1:] |= numpy.diff(reads[:, 1] != 0)
     return reads[m]
+
+
+def iter_merge_close_reads(chunks, threshold=1000):
+    """merge_close_reads for a stream of time sorted read chunks"""
+    last = None
+    for reads in chunks:
+        if not len(reads):
+            continue
+        if last is None:
+            yield merge_close_reads(reads, threshold)
+        else:
+            # compare the first read to the last of the previous chunk
+            yield merge_close_reads(
+                numpy.vstack((last, reads)), threshold)[1:]
+        last = reads[-1:]
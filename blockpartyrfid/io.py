@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 
+import json
+import multiprocessing
 import os
+from io import BytesIO
 
 import numpy
 
-#from . import touch
+from . import consts
+from . import db
+from . import touch
 
 
 def get_images(image_directory):
@@ -33,7 +38,8 @@ def get_log_files(log_directory):
 
 
 def dc(v):
-    v = v.decode('utf-8')
+    if isinstance(v, bytes):
+        v = v.decode('utf-8')
     if v in 'LR':
         return 'LR'.index(v)
     if v in 'ub':
@@ -47,27 +53,442 @@ def dc(v):
     return v
 
 
-def load_log(log_filename):
+# byte lookup tables for the vectorized parser
+_dec_lut = numpy.full(256, -1, dtype='int8')
+_dec_lut[ord('0'):ord('9') + 1] = numpy.arange(10)
+_hex_lut = _dec_lut.copy()
+_hex_lut[ord('a'):ord('f') + 1] = numpy.arange(10, 16)
+_hex_lut[ord('A'):ord('F') + 1] = numpy.arange(10, 16)
+# single character codes (see dc): L/R, u/b, f/r
+_code_lut = numpy.full(256, -1, dtype='int8')
+for _s in ('LR', 'ub', 'fr'):
+    for (_i, _c) in enumerate(_s):
+        _code_lut[ord(_c)] = _i
+# longest fields that fit in an int64
+_max_dec_width = 18
+_max_hex_width = 15
+# rows parsed at once (keeps the per-character arrays in cache)
+_parse_block_size = 1 << 14
+
+
+def _parse_column(buf, ends, lengths, as_data):
+    """Parse one column of fields (given by end offsets into buf)
+    returns an int64 array or None if any field needs the slow path"""
+    if not as_data:
+        # optional leading minus sign
+        neg = (lengths > 0) & (buf[ends - lengths] == ord('-'))
+        lengths = lengths - neg
+    if lengths.min() == 0:
+        return None
+    width = lengths.max()
+    if width > max(_max_dec_width, _max_hex_width if as_data else 0):
+        return None
+    # right aligned (n, width) matrix of characters, k = 0 is the last
+    ks = numpy.arange(width)
+    valid = ks < lengths[:, None]
+    chars = buf[numpy.maximum(ends[:, None] - 1 - ks, 0)]
+    d = _dec_lut[chars]
+    is_dec = numpy.all((d >= 0) | ~valid, axis=1)
+    is_dec &= lengths <= _max_dec_width
+    d[~valid] = 0
+    dv = d.astype('int64').dot(
+        10 ** numpy.minimum(ks, _max_dec_width - 1).astype('int64'))
+    if not as_data:
+        if not numpy.all(is_dec):
+            return None
+        return numpy.where(neg, -dv, dv)
+    # codes take precedence over numbers (as in dc)
+    codes = numpy.where(lengths == 1, _code_lut[chars[:, 0]], -1)
+    is_code = codes >= 0
+    if numpy.all(is_code | is_dec):
+        return numpy.where(is_code, codes, dv)
+    h = _hex_lut[chars]
+    is_hex = numpy.all((h >= 0) | ~valid, axis=1)
+    is_hex &= lengths <= _max_hex_width
+    if not numpy.all(is_code | is_dec | is_hex):
+        return None
+    h[~valid] = 0
+    hv = h.astype('int64').dot(
+        16 ** numpy.minimum(ks, _max_hex_width - 1).astype('int64'))
+    return numpy.where(is_code, codes, numpy.where(is_dec, dv, hv))
+
+
+def parse_log(data):
+    """Parse the bytes of a log file without per-cell python calls
+    returns the same array as numpy.loadtxt with dc converters or None
+    if the data contains anything (comments, blank lines, signs or
+    whitespace in data columns, etc) the fast parser does not handle"""
+    if b'\r' in data:
+        data = data.replace(b'\r', b'')
+    if len(data) == 0:
+        return numpy.empty((0, 5), dtype='int64')
+    if not data.endswith(b'\n'):
+        data += b'\n'
+    if b'#' in data or b'\n\n' in data or data.startswith(b'\n'):
+        return None
+    buf = numpy.frombuffer(data, dtype='uint8')
+    seps = numpy.flatnonzero((buf == ord(',')) | (buf == ord('\n')))
+    if len(seps) % 5:
+        return None
+    seps = seps.reshape(-1, 5)
+    if (
+            numpy.any(buf[seps[:, :4]] != ord(',')) or
+            numpy.any(buf[seps[:, 4]] != ord('\n'))):
+        return None
+    starts = numpy.empty_like(seps)
+    starts[:, 1:] = seps[:, :-1] + 1
+    starts[0, 0] = 0
+    starts[1:, 0] = seps[:-1, 4] + 1
+    lengths = seps - starts
+    vs = numpy.empty(seps.shape, dtype='int64')
+    for i in range(0, len(vs), _parse_block_size):
+        s = slice(i, i + _parse_block_size)
+        for ci in range(5):
+            cvs = _parse_column(
+                buf, seps[s, ci], lengths[s, ci],
+                as_data=ci in (consts.DATA0_COLUMN, consts.DATA1_COLUMN))
+            if cvs is None:
+                return None
+            vs[s, ci] = cvs
+    return vs
+
+
+def load_log(log_filename, fast=True):
     # 0: time
     # 1: board
     # 2: event type
     # 3: data0
     # 4: data1
+    if fast:
+        with open(log_filename, 'rb') as f:
+            vs = parse_log(f.read())
+        if vs is not None:
+            return vs
     vs = numpy.loadtxt(
-        log_filename, delimiter=',', converters={3: dc, 4: dc}, dtype='int64')
+        log_filename, delimiter=',', converters={3: dc, 4: dc},
+        dtype='int64', ndmin=2)
+    return vs
+
+
+def load_log_bytes(data):
+    """Parse log file contents (bytes), always returns an (n, 5) array"""
+    vs = parse_log(data)
+    if vs is not None:
+        return vs
+    return numpy.loadtxt(
+        BytesIO(data), delimiter=',', converters={3: dc, 4: dc},
+        dtype='int64', ndmin=2)
+
+
+def count_log_rows(log_filename, chunk_size=1 << 20):
+    """Upper bound on the number of rows in a log file (# of lines)"""
+    n = 0
+    last = b'\n'
+    with open(log_filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            n += chunk.count(b'\n')
+            last = chunk[-1:]
+    if last != b'\n':
+        n += 1
+    return n
+
+
+def iter_logs(log_filenames, n_workers=None):
+    """Yield parsed (n, 5) arrays for each log file (in the order given)
+    if n_workers is > 1, files are parsed in a pool of n_workers processes"""
+    log_filenames = list(log_filenames)
+    pool = None
+    if n_workers is not None and n_workers > 1 and len(log_filenames) > 1:
+        pool = multiprocessing.Pool(n_workers)
+        lvs = pool.imap(load_log, log_filenames)
+    else:
+        lvs = map(load_log, log_filenames)
+    try:
+        for lv in lvs:
+            # loadtxt returns 1d arrays for single row files
+            yield lv.reshape(-1, 5)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def load_logs(log_filenames, n_workers=None):
+    """Load and concatenate several log files (in the order given)
+    rows are copied into a single pre-allocated array as files finish"""
+    log_filenames = list(log_filenames)
+    n = sum(count_log_rows(fn) for fn in log_filenames)
+    vs = numpy.empty((n, 5), dtype='int64')
+    i = 0
+    for lv in iter_logs(log_filenames, n_workers):
+        vs[i:i + len(lv)] = lv
+        i += len(lv)
+    return vs[:i]
+
+
+# version of the parsed event format, bump to invalidate existing caches
+# when parsing (or binarizing touch events) changes
+cache_version = 1
+
+
+def _file_key(fn):
+    st = os.stat(fn)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def load_cached_logs(log_filenames, cache_directory, n_workers=None):
+    """Load log files through a cache of parsed .npy chunks
+    Each file is parsed once and saved as <cache>/<name>.npy, keyed on the
+    file size and mtime. The concatenation of all chunks is also saved
+    (as events.npy) and returned memory mapped (read only). Only new or
+    modified files are re-parsed (all files are re-parsed if the cache
+    was written with a different cache_version)."""
+    log_filenames = list(log_filenames)
+    if not os.path.exists(cache_directory):
+        os.makedirs(cache_directory)
+    manifest_fn = os.path.join(cache_directory, 'manifest.json')
+    events_fn = os.path.join(cache_directory, 'events.npy')
+    manifest = {'version': cache_version, 'files': {}, 'events': None}
+    if os.path.exists(manifest_fn):
+        with open(manifest_fn, 'r') as f:
+            m = json.load(f)
+        if m.get('version') == cache_version:
+            manifest = m
+    keys = [
+        [os.path.basename(fn), ] + _file_key(fn) for fn in log_filenames]
+    if manifest['events'] == keys and os.path.exists(events_fn):
+        return numpy.load(events_fn, mmap_mode='r')
+
+    # re-parse new or modified files
+    files = manifest['files']
+    chunk_fns = [
+        os.path.join(cache_directory, k[0] + '.npy') for k in keys]
+    stale = [
+        i for (i, k) in enumerate(keys)
+        if files.get(k[0]) != k[1:] or not os.path.exists(chunk_fns[i])]
+    manifest['events'] = None
+    for (i, lv) in zip(stale, iter_logs(
+            [log_filenames[i] for i in stale], n_workers)):
+        # write to a new file so existing memory maps stay valid
+        numpy.save(chunk_fns[i] + '.tmp.npy', lv)
+        os.replace(chunk_fns[i] + '.tmp.npy', chunk_fns[i])
+        files[keys[i][0]] = keys[i][1:]
+
+    # combine chunks
+    chunks = [numpy.load(fn, mmap_mode='r') for fn in chunk_fns]
+    vs = numpy.lib.format.open_memmap(
+        events_fn + '.tmp.npy', mode='w+', dtype='int64',
+        shape=(sum(len(c) for c in chunks), 5))
+    i = 0
+    for c in chunks:
+        vs[i:i + len(c)] = c
+        i += len(c)
+    vs.flush()
+    del vs, chunks
+    os.replace(events_fn + '.tmp.npy', events_fn)
+    manifest['events'] = keys
+    with open(manifest_fn, 'w') as f:
+        json.dump(manifest, f)
+    return numpy.load(events_fn, mmap_mode='r')
+
+
+def load_cached_touch(touch_filenames, cache_directory, n_workers=None):
+    """Load and binarize (see touch.binarize) touch log files through a
+    cache. The binary touch events are saved as <cache>/touch.npy (and
+    the thresholds as touch_thresholds.json) keyed on cache_version and
+    the size and mtime of all touch files and returned memory mapped
+    (read only)"""
+    touch_filenames = list(touch_filenames)
+    if not os.path.exists(cache_directory):
+        os.makedirs(cache_directory)
+    manifest_fn = os.path.join(cache_directory, 'touch.json')
+    events_fn = os.path.join(cache_directory, 'touch.npy')
+    manifest = {
+        'version': cache_version,
+        'files': [
+            [os.path.basename(fn), ] + _file_key(fn)
+            for fn in touch_filenames],
+    }
+    if os.path.exists(manifest_fn) and os.path.exists(events_fn):
+        with open(manifest_fn, 'r') as f:
+            if json.load(f) == manifest:
+                return numpy.load(events_fn, mmap_mode='r')
+    td, ts = touch.binarize(load_logs(touch_filenames, n_workers))
+    numpy.save(events_fn + '.tmp.npy', td)
+    os.replace(events_fn + '.tmp.npy', events_fn)
+    touch.save_thresholds(
+        ts, os.path.join(cache_directory, 'touch_thresholds.json'))
+    with open(manifest_fn, 'w') as f:
+        json.dump(manifest, f)
+    return numpy.load(events_fn, mmap_mode='r')
+
+
+def is_time_sorted(vs):
+    t = vs[:, consts.TIME_COLUMN]
+    return bool(numpy.all(t[1:] >= t[:-1]))
+
+
+def sort_by_time(vs):
+    """Stable sort events by time (returns vs if already sorted)"""
+    if is_time_sorted(vs):
+        return vs
+    return vs[numpy.argsort(vs[:, consts.TIME_COLUMN], kind='stable')]
+
+
+def merge_sorted_events(a, b):
+    """Merge two time sorted event arrays into one time sorted array
+    (events of a before events of b at the same time)"""
+    if not (is_time_sorted(a) and is_time_sorted(b)):
+        raise ValueError("Events must be sorted by time to merge")
+    ta = a[:, consts.TIME_COLUMN]
+    tb = b[:, consts.TIME_COLUMN]
+    # final row of each event in b
+    bi = numpy.searchsorted(ta, tb, side='right') + numpy.arange(len(b))
+    vs = numpy.empty((len(a) + len(b), a.shape[1]), dtype=a.dtype)
+    ai = numpy.ones(len(vs), dtype='bool')
+    ai[bi] = False
+    vs[bi] = b
+    vs[ai] = a
     return vs
 
 
 def load_log_directory(
-        log_directory, and_touch=False, binarize_touch=True, filter_rfid=True):
+        log_directory, and_touch=False, binarize_touch=True, filter_rfid=True,
+        n_workers=None, cache=False, compact=False):
+    """Load all (non-empty) logs in a directory
+    if cache is True, parsed events are cached (see load_cached_logs) in
+    a .cache sub-directory (or cache can be a directory name) and
+    the returned array is a read-only memory map (unless touch events
+    are merged in, binarized touch events are also cached)
+    if compact is True, events are returned as consts.compact_event_dtype"""
     fns, tfns = get_log_files(log_directory)
     fns = [fn for fn in fns if os.path.getsize(fn) != 0]
     tfns = [tfn for tfn in tfns if os.path.getsize(tfn) != 0]
-    d = numpy.vstack([load_log(fn) for fn in fns])
+    if cache:
+        if cache is True:
+            cache = os.path.join(log_directory, '.cache')
+        d = load_cached_logs(fns, cache, n_workers)
+    else:
+        d = load_logs(fns, n_workers)
     if and_touch:
-        td = numpy.vstack([load_log(fn) for fn in tfns])
-        if binarize_touch:
-            td, _ = touch.binarize(td)
-        d = numpy.vstack((d, td))
-        d = d[numpy.argsort(d[:, 0])]
+        if binarize_touch and cache:
+            td = load_cached_touch(tfns, cache, n_workers)
+        elif binarize_touch:
+            td, _ = touch.binarize(load_logs(tfns, n_workers))
+        else:
+            td = sort_by_time(load_logs(tfns, n_workers))
+        # files are joined in filename order (e.g. one file per board)
+        d = merge_sorted_events(sort_by_time(d), td)
+    if compact:
+        d = db.to_compact(d)
     return d
+
+
+def iter_log_blocks(log_filename, block_size=1 << 22):
+    """Yield (n, 5) arrays parsed from ~block_size bytes of a log at a time"""
+    rest = b''
+    with open(log_filename, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            data = rest + data
+            i = data.rfind(b'\n') + 1
+            rest = data[i:]
+            if i:
+                yield load_log_bytes(data[:i])
+    if rest:
+        yield load_log_bytes(rest)
+
+
+def merge_log_blocks(block_iterators, chunk_size=1000000):
+    """k-way merge of several streams of time sorted event blocks
+    yields time sorted (<= chunk_size, 5) arrays"""
+    its = [iter(i) for i in block_iterators]
+    bufs = [None] * len(its)
+    pending = []
+    n_pending = 0
+    while True:
+        # refill empty buffers, dropping exhausted streams
+        for i in range(len(its)):
+            while its[i] is not None and (bufs[i] is None or not len(bufs[i])):
+                bufs[i] = next(its[i], None)
+                if bufs[i] is None:
+                    its[i] = None
+        live = [i for i in range(len(its)) if its[i] is not None]
+        if len(live) == 0:
+            break
+        # rows up to the smallest 'last time' of all buffers are safe
+        # to emit as no stream can produce an earlier event
+        t = min(bufs[i][-1, consts.TIME_COLUMN] for i in live)
+        vs = []
+        for i in live:
+            n = numpy.searchsorted(
+                bufs[i][:, consts.TIME_COLUMN], t, side='right')
+            vs.append(bufs[i][:n])
+            bufs[i] = bufs[i][n:]
+        vs = numpy.vstack(vs)
+        pending.append(
+            vs[numpy.argsort(vs[:, consts.TIME_COLUMN], kind='stable')])
+        n_pending += len(vs)
+        while n_pending >= chunk_size:
+            vs = numpy.vstack(pending)
+            yield vs[:chunk_size]
+            pending = [vs[chunk_size:]]
+            n_pending = len(pending[0])
+    if n_pending:
+        yield numpy.vstack(pending)
+
+
+def iter_log_directory(log_directory, chunk_size=1000000, block_size=1 << 22):
+    """Stream all (non-touch) events in a directory in time order
+    Files are read block_size bytes at a time and merged so memory is
+    bounded by ~(# files * block_size + chunk_size rows). Each log file
+    must be sorted by time. Yields (<= chunk_size, 5) arrays."""
+    fns, _ = get_log_files(log_directory)
+    fns = [fn for fn in fns if os.path.getsize(fn) != 0]
+    return merge_log_blocks(
+        [iter_log_blocks(fn, block_size) for fn in fns], chunk_size)
+
+
+class LogFollower(object):
+    """Incrementally read a log directory that is still being written
+
+    Each call to read parses only complete lines appended to the (non-touch)
+    log files since the previous call (including files that appeared in
+    the meantime) and returns them as one time sorted (n, 5) array.
+    """
+    def __init__(self, log_directory):
+        self.log_directory = log_directory
+        # (device, inode) and byte offset of the first unread line for
+        # each file
+        self.offsets = {}
+
+    def read_file(self, fn):
+        with open(fn, 'rb') as f:
+            st = os.fstat(f.fileno())
+            identity = (st.st_dev, st.st_ino)
+            previous, offset = self.offsets.get(fn, (identity, 0))
+            if previous != identity or st.st_size < offset:
+                # file was replaced or truncated, start over
+                offset = 0
+            f.seek(offset)
+            data = f.read()
+        # only parse complete lines
+        data = data[:data.rfind(b'\n') + 1]
+        self.offsets[fn] = (identity, offset + len(data))
+        return load_log_bytes(data)
+
+    def read(self):
+        fns, _ = get_log_files(self.log_directory)
+        vs = [self.read_file(fn) for fn in fns]
+        vs = [v for v in vs if len(v)]
+        if len(vs) == 0:
+            return numpy.empty((0, 5), dtype='int64')
+        if len(vs) == 1:
+            return vs[0]
+        vs = numpy.vstack(vs)
+        return vs[numpy.argsort(vs[:, consts.TIME_COLUMN], kind='stable')]
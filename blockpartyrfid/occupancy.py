@@ -23,8 +23,26 @@ state_weights = {
 }
 
 
+# sensor events used to measure rfid reads
+sensor_events = (consts.EVENT_BEAM, consts.EVENT_TOUCH_BINARY)
+
+# one measured rfid read (see measure_rfid_reads_array), missing times are nan
+measured_read_dtype = numpy.dtype([
+    ('timestamp', 'int64'),
+    ('board_id', 'int64'),
+    ('animal_id', 'int64'),
+    ('prev_board', 'f8'),
+    ('next_board', 'f8'),
+    ('prev_animal', 'f8'),
+    ('next_animal', 'f8'),
+    # time of [sensor_events index, side, state]
+    ('sensors', 'f8', (len(sensor_events), 2, 2)),
+])
+
+
 def merge_occupancies(occupancies, cull=True):
     # merge
+    occupancies = list(occupancies)
     if len(occupancies) > 1:
         occupancy = numpy.vstack(occupancies)
     else:
@@ -35,44 +53,33 @@ def merge_occupancies(occupancies, cull=True):
     if not cull:
         return occupancy
 
-    # find conflicting
-    n = len(occupancy)
-    m = numpy.ones(n, dtype='bool')
-    for i in range(n):
-        if i == n - 1:
-            continue
-        i0 = i
-        o = occupancy[i]
-
-        i += 1
-        cinds = []
-        while i < n:
-            # check next
-            c = occupancy[i]
-            if c[0] < o[1] and c[3] == o[3]:
-                # conflict
-                cinds.append(i)
-                # print("Found conflict:", o, occupancy[i][0], i, i0)
-            elif c[0] > o[1]:
-                i = n
-            i += 1
-        if len(cinds) == 0:
-            continue
-        c = occupancy[[i0, ] + cinds]
-        # make sure all times agree
-        sad = numpy.sum(numpy.abs(numpy.diff(c[:, :2], axis=0)))
-        if sad != 0:
-            raise Exception()
-        # pick one with largest confidence
-        ci = numpy.argmax(numpy.abs(c[:, 4]))
-        for i in cinds:
-            if i == ci:
-                continue
-            m[i] = False
-        #if abs(c[4]) > abs(o[4]):
-        #    m[i0] = False
-        #else:
-        #    m[cinds[0]] = False
+    # find conflicting: overlapping rows for the same animal
+    # sort by animal (keeping time order) and compare each start to the
+    # latest end of the earlier rows for that animal
+    order = numpy.argsort(occupancy[:, 3], kind='stable')
+    o = occupancy[order]
+    st, et = o[:, 0], o[:, 1]
+    first = numpy.ones(len(o), dtype='bool')
+    first[1:] = o[1:, 3] != o[:-1, 3]
+    prev = numpy.empty_like(et)
+    prev[1:] = db.grouped_running_max(et, first)[:-1]
+    conflict = ~first & (st < prev)
+    if not numpy.any(conflict):
+        return occupancy
+    # group conflicting rows
+    gid = numpy.cumsum(~conflict) - 1
+    gfirst = numpy.where(~conflict)[0][gid]
+    # make sure all times agree
+    if numpy.any(
+            (st[conflict] != st[gfirst[conflict]]) |
+            (et[conflict] != et[gfirst[conflict]])):
+        raise Exception("Conflicting occupancies with different times")
+    # pick one with largest confidence (first on ties)
+    corder = numpy.lexsort((-numpy.abs(o[:, 4]), gid))
+    keep = numpy.ones(len(o), dtype='bool')
+    keep[1:] = gid[corder][1:] != gid[corder][:-1]
+    m = numpy.empty(len(o), dtype='bool')
+    m[order[corder]] = keep
     return occupancy[m]
 
 
@@ -201,9 +208,124 @@ def measure_rfid_reads(events, board=None):
     return data
 
 
+def _group_neighbor_times(times, groups, first_match=False):
+    """times of the previous and next element in the same group (nan if
+    there is none). If first_match, elements with the same group and time
+    all use the neighbors of the first of them."""
+    order = numpy.lexsort((times, groups))
+    t = times[order].astype('f8')
+    g = groups[order]
+    n = len(t)
+    j = numpy.arange(n)
+    if first_match and n:
+        is_first = numpy.ones(n, dtype='bool')
+        is_first[1:] = (g[1:] != g[:-1]) | (t[1:] != t[:-1])
+        j = numpy.maximum.accumulate(numpy.where(is_first, j, 0))
+    pi = numpy.maximum(j - 1, 0)
+    ni = numpy.minimum(j + 1, n - 1)
+    prev = numpy.where((j > 0) & (g[pi] == g[j]), t[pi], numpy.nan)
+    nxt = numpy.where((j < n - 1) & (g[ni] == g[j]), t[ni], numpy.nan)
+    rp = numpy.empty(n)
+    rn = numpy.empty(n)
+    rp[order] = prev
+    rn[order] = nxt
+    return rp, rn
+
+
+def measure_rfid_reads_array(events):
+    """Batch version of measure_rfid_reads
+    returns a measured_read_dtype array (one row per rfid read sorted by
+    time). Sensor times are the closest triggered (broken/touched) event
+    to each read and the first released event at or after it."""
+    rfid = db.sel(events, event='rfid')
+    rfid = rfid[numpy.lexsort((
+        rfid[:, consts.BOARD_COLUMN], rfid[:, consts.TIME_COLUMN]))]
+    ts = rfid[:, consts.TIME_COLUMN]
+    bids = rfid[:, consts.BOARD_COLUMN]
+    mr = numpy.empty(len(rfid), dtype=measured_read_dtype)
+    mr['timestamp'] = ts
+    mr['board_id'] = bids
+    mr['animal_id'] = rfid[:, consts.RFID_ID_COLUMN]
+    mr['prev_board'], mr['next_board'] = _group_neighbor_times(ts, bids)
+    mr['prev_animal'], mr['next_animal'] = _group_neighbor_times(
+        ts, mr['animal_id'], first_match=True)
+    mr['sensors'] = numpy.nan
+
+    index = db.EventIndex(events)
+    for bid in numpy.unique(bids):
+        m = bids == bid
+        bts = ts[m]
+        sd = mr['sensors'][m]
+        for (ei, evt) in enumerate(sensor_events):
+            triggered, released = consts.states[evt]
+            for side in consts.sides[evt]:
+                tevs = index.sel(
+                    board=bid, event=evt, data0=side, data1=triggered,
+                    by_time=True)
+                ti = db.closest_events(tevs, bts)
+                found = ti != consts.NO_EVENT
+                te = tevs[ti[found], consts.TIME_COLUMN]
+                sd[found, ei, side, triggered] = te
+                # next released event
+                revs = index.sel(
+                    board=bid, event=evt, data0=side, data1=released,
+                    by_time=True)
+                ri = db.next_events(revs, te)
+                rfound = numpy.flatnonzero(found)[ri != consts.NO_EVENT]
+                sd[rfound, ei, side, released] = revs[
+                    ri[ri != consts.NO_EVENT], consts.TIME_COLUMN]
+        mr['sensors'][m] = sd
+    return mr
+
+
+def _measured_read_array_to_occupancy(
+        mr, sensor_timeout, threshold, start_time, end_time):
+    ts = mr['timestamp']
+    direction = numpy.zeros(len(mr), dtype='int64')
+    for (ei, evt) in enumerate(sensor_events):
+        ew = event_weights[evt]
+        left, right = consts.sides[evt]
+        for state in consts.states[evt]:
+            sw = state_weights[evt][state]
+            lt = mr['sensors'][:, ei, left, state]
+            rt = mr['sensors'][:, ei, right, state]
+            # nan comparisons are False so missing times are skipped
+            m = (
+                (numpy.abs(lt - ts) < sensor_timeout) &
+                (numpy.abs(rt - ts) < sensor_timeout))
+            direction[m & (lt > rt)] -= sw * ew
+            direction[m & ~(lt > rt)] += sw * ew
+    m = (numpy.abs(direction) > threshold) & (direction != 0)
+    mr, direction = mr[m], direction[m]
+    # before/after cage offsets: right move (0, 1), left move (1, 0)
+    before = (direction < 0).astype('int64')
+    st = numpy.where(
+        numpy.isnan(mr['prev_animal']), start_time, mr['prev_animal'])
+    et = numpy.where(
+        numpy.isnan(mr['next_animal']), end_time, mr['next_animal'])
+    # enter, exit, cage, animal, confidence (2 rows per read)
+    occupancy = numpy.empty((len(mr), 2, 5), dtype='int64')
+    occupancy[:, 0] = numpy.column_stack((
+        st, mr['timestamp'], mr['board_id'] + before,
+        mr['animal_id'], direction))
+    occupancy[:, 1] = numpy.column_stack((
+        mr['timestamp'], et, mr['board_id'] + 1 - before,
+        mr['animal_id'], direction))
+    return occupancy.reshape(-1, 5)
+
+
 def measured_rfid_reads_to_occupancy(
         mrfids, sensor_timeout=2000, threshold=0,
         start_time=None, end_time=None):
+    """mrfids: output of measure_rfid_reads (list of dicts) or
+    measure_rfid_reads_array (in which case an array is returned)"""
+    if isinstance(mrfids, numpy.ndarray):
+        if start_time is None:
+            start_time = mrfids['timestamp'][0]
+        if end_time is None:
+            end_time = mrfids['timestamp'][-1]
+        return _measured_read_array_to_occupancy(
+            mrfids, sensor_timeout, threshold, start_time, end_time)
     if start_time is None:
         start_time = mrfids[0]['timestamp']
     if end_time is None:
@@ -255,9 +377,40 @@ def measured_rfid_reads_to_occupancy(
     return occupancy
 
 
+def _isolated_transition_details(irfid, irfid_inds, st, direction):
+    # per-read diagnostic dicts (see by_isolated_transitions)
+    def v(x):
+        return None if numpy.isnan(x) else x
+
+    irfid_dict = []
+    for (j, (i, ev)) in enumerate(zip(irfid_inds, irfid)):
+        d = {
+            'event': ev,
+            'i': i,
+            't': ev[consts.TIME_COLUMN],
+            'b': ev[consts.BOARD_COLUMN],
+            'a': ev[consts.RFID_ID_COLUMN],
+            'd': {},
+            'dt': {},
+            'direction': direction[j],
+        }
+        for (ei, et) in enumerate(sensor_events):
+            d['d'][et] = {
+                side: [v(st[j, ei, side, 0]), v(st[j, ei, side, 1])]
+                for side in consts.sides[et]}
+            d['dt'][et] = [
+                v(st[j, ei, 0, k] - st[j, ei, 1, k]) for k in (0, 1)]
+        irfid_dict.append(d)
+    return irfid_dict
+
+
 def by_isolated_transitions(
         events, board, timeout=2000,
-        threshold=4):
+        threshold=4, details=False):
+    """Occupancy from rfid reads with no other read on this board within
+    timeout that have agreeing beam/touch left/right timings
+    returns occupancy [enter time, exit time, cage #, animal #, direction]
+    and (if details is True, otherwise None) a list of per-read dicts"""
     rfid = db.sel(events, event='rfid')
 
     # get events for this board
@@ -277,108 +430,86 @@ def by_isolated_transitions(
     # get isolated rfid events
     irfid = brfid[rfid_mask]
     irfid_inds = numpy.where(rfid_mask)[0]
-
-    irfid_dict = [
-        {
-            'event': ev,
-            'i': i,
-            't': ev[consts.TIME_COLUMN],
-            'b': ev[consts.BOARD_COLUMN],
-            'a': ev[consts.RFID_ID_COLUMN],
-            'd': {},
-        } for (i, ev) in zip(irfid_inds, irfid)]
+    i_ts = irfid[:, consts.TIME_COLUMN]
 
     # find beam/touch break/unbreak for left/right for each isolated event
-    i_ts = irfid[:, consts.TIME_COLUMN]
-    sevs = db.split_events(bevents, board=False)
+    # st[read, sensor_events index, side, 0 = active / 1 = inactive time]
+    st = numpy.full((len(irfid), len(sensor_events), 2, 2), numpy.nan)
+    index = db.EventIndex(bevents)
+    for (ei, et) in enumerate(sensor_events):
+        active, inactive = consts.states[et]
+        for side in consts.sides[et]:
+            # find closest active (broken/touched) event
+            aevs = index.sel(
+                event=et, data0=side, data1=active, by_time=True)
+            ai = db.closest_events(aevs, i_ts)
+            found = ai != consts.NO_EVENT
+            a_t = aevs[ai[found], consts.TIME_COLUMN]
+            st[found, ei, side, 0] = a_t
+            # find next inactive event within timeout
+            its = index.sel(
+                event=et, data0=side, data1=inactive,
+                by_time=True)[:, consts.TIME_COLUMN]
+            if not len(its):
+                continue
+            k = numpy.searchsorted(its, a_t, side='right')
+            i_t = its[numpy.minimum(k, len(its) - 1)]
+            valid = (k < len(its)) & (i_t < a_t + timeout)
+            st[numpy.flatnonzero(found)[valid], ei, side, 1] = i_t[valid]
 
-    # sevs[event_type][side][state], m
-    for et in (consts.EVENT_BEAM, consts.EVENT_TOUCH_BINARY):
-        if et == consts.EVENT_BEAM:
-            sides = (consts.BEAM_LEFT, consts.BEAM_RIGHT)
-            active, inactive = (consts.BEAM_BROKEN, consts.BEAM_UNBROKEN)
-        else:
-            sides = (consts.TOUCH_LEFT, consts.TOUCH_RIGHT)
-            active, inactive = (consts.TOUCH_TOUCHED, consts.TOUCH_UNTOUCHED)
-        for side in sides:
-            aevs = sevs[et][side][active]  # active events
-            ievs = sevs[et][side][inactive]  # inactive events
-            # find closest broken/touched event
-            adj = db.find_adjacent(irfid, aevs)  # adjacent times
-
-            # for each valid adjacent time, find next inactive event
-            for (i, a) in enumerate(adj):
-                if et not in irfid_dict[i]['d']:
-                    irfid_dict[i]['d'][et] = {}
-                a_t = a[numpy.nanargmin(numpy.abs(a[:2] - irfid_dict[i]['t']))]
-                if numpy.isnan(a_t):
-                    # invalid, use None for both
-                    a_t, i_t = None, None
-                else:
-                    i_ev = db.sel(ievs, timerange=(a_t, a_t + timeout))
-                    if len(i_ev):
-                        i_t = i_ev[0, consts.TIME_COLUMN]
-                    else:
-                        i_t = None
-                irfid_dict[i]['d'][et][side] = [a_t, i_t]
+    # score by how many left/right active & inactive timings agree
+    # TODO deal with touch left != beam left
+    direction = numpy.zeros(len(irfid), dtype='int64')
+    l, r = st[:, :, consts.BEAM_LEFT], st[:, :, consts.BEAM_RIGHT]
+    valid = ~(numpy.isnan(l) | numpy.isnan(r))
+    direction += numpy.sum(valid & (l < r), axis=(1, 2))
+    direction -= numpy.sum(valid & ~(l < r), axis=(1, 2))
 
-    occupancy = []
+    # valid transitions, mark occupancy before (or after for an
+    # animal's first read)
+    # [enter time, exit time, cage #, animal #, threshold]
+    tm = numpy.abs(direction) >= threshold
+    tr, tdir = irfid[tm], direction[tm]
     # needs access to all rfid events not just the ones for this board
-    aevs = db.by_animal(rfid)
-    # for each irfid_dict, compute the dt for beam/touch and active/inactive
-    # if they all agree, consider this a transition
-    # maybe score by how many agree
-    # ba_dt = 1, bi_dt = 1, ta_dt, ti_dt
-    for i in irfid_dict:
-        i['dt'] = {}
-        i['direction'] = 0
-        for et in (consts.EVENT_BEAM, consts.EVENT_TOUCH_BINARY):
-            # TODO deal with touch left != beam left
-            a_l, i_l = i['d'][et][consts.BEAM_LEFT]
-            a_r, i_r = i['d'][et][consts.BEAM_RIGHT]
-            if (a_l is not None) and (a_r is not None):
-                a_dt = a_l - a_r
-                if a_l < a_r:
-                    i['direction'] += 1
-                else:
-                    i['direction'] -= 1
-            else:
-                a_dt = None
-            if (i_l is not None) and (i_r is not None):
-                i_dt = i_l - i_r
-                if i_l < i_r:
-                    i['direction'] += 1
-                else:
-                    i['direction'] -= 1
-            else:
-                i_dt = None
-            i['dt'][et] = [a_dt, i_dt]
-        if abs(i['direction']) >= threshold:
-            if i['direction'] > 0:
-                before, after = 0, 1
-            else:
-                before, after = 1, 0
-            # TODO valid transition, mark occupancy before and after
-            # [enter time, exit time, cage #, animal #, threshold]
-            # find this event
-            evs = aevs[i['a']]
-            evi = numpy.where(evs[:, consts.TIME_COLUMN] == i['t'])[0]
-            if len(evi) != 1:
-                raise Exception("Failed to re-find rfid event")
-            evi = evi[0]
-            if evi != 0:  # log before
-                enter_time = evs[evi - 1][consts.TIME_COLUMN]
-                exit_time = i['t']
-                cage_n = i['b'] + before
-                occupancy.append(
-                    [enter_time, exit_time, cage_n, i['a'], i['direction']])
-            elif evi != len(evs) - 1:  # log after
-                enter_time = i['t']
-                exit_time = evs[evi + 1][consts.TIME_COLUMN]
-                cage_n = i['b'] + after
-                occupancy.append(
-                    [enter_time, exit_time, cage_n, i['a'], i['direction']])
-    return numpy.array(occupancy), irfid_dict
+    arfid = rfid[numpy.isin(
+        rfid[:, consts.RFID_ID_COLUMN], db.all_animals(rfid))]
+    key_dtype = [('a', 'int64'), ('t', 'int64')]
+    keys = numpy.empty(len(arfid), dtype=key_dtype)
+    keys['a'] = arfid[:, consts.RFID_ID_COLUMN]
+    keys['t'] = arfid[:, consts.TIME_COLUMN]
+    keys = numpy.sort(keys, kind='stable')
+    tkeys = numpy.empty(len(tr), dtype=key_dtype)
+    tkeys['a'] = tr[:, consts.RFID_ID_COLUMN]
+    tkeys['t'] = tr[:, consts.TIME_COLUMN]
+    # find this event in the animal's reads
+    evi = numpy.searchsorted(keys, tkeys, side='left')
+    if numpy.any(numpy.searchsorted(keys, tkeys, side='right') - evi != 1):
+        raise Exception("Failed to re-find rfid event")
+    before = (tdir < 0).astype('int64')
+    has_prev = (evi > 0) & (
+        keys['a'][numpy.maximum(evi - 1, 0)] == tkeys['a'])
+    has_next = (evi < len(keys) - 1) & (
+        keys['a'][numpy.minimum(evi + 1, len(keys) - 1)] == tkeys['a'])
+    # log before, or if this is the first read, log after
+    after = ~has_prev & has_next
+    m = has_prev | after
+    occupancy = numpy.empty((numpy.count_nonzero(m), 5), dtype='int64')
+    t = tkeys['t'][m]
+    pt = keys['t'][numpy.maximum(evi - 1, 0)][m]
+    nt = keys['t'][numpy.minimum(evi + 1, len(keys) - 1)][m]
+    am = after[m]
+    occupancy[:, 0] = numpy.where(am, t, pt)
+    occupancy[:, 1] = numpy.where(am, nt, t)
+    occupancy[:, 2] = tr[m, consts.BOARD_COLUMN] + numpy.where(
+        am, 1 - before[m], before[m])
+    occupancy[:, 3] = tkeys['a'][m]
+    occupancy[:, 4] = tdir[m]
+
+    irfid_dict = None
+    if details:
+        irfid_dict = _isolated_transition_details(
+            irfid, irfid_inds, st, direction)
+    return occupancy, irfid_dict
 
 
 def assign_direction_to_tube_events(te):
@@ -561,7 +692,70 @@ def merge_tube_event_occupancys(o0, o1, animal=None):
     return numpy.array(occupancy)
 
 
+def _trace_chains(tubes, starts, forward):
+    """Trace the cage sequence implied by the tube sequence from each start
+    (see from_tube_sequence). A chain that arrives at the starting state
+    of another start would repeat that start's chain so it stops there
+    and records a join. Each read/cage state is traced at most once.
+    returns (m, 2) [index, cage] array of all traced states, segment
+    [first, last) into it for each start and the start each joins (or -1)
+    """
+    n = len(tubes)
+    start_cage = {s['i']: s['cage'] for s in starts}
+    # state (read index, cage) at which each start's trace begins
+    offset = 1 if forward else 0
+    origins = {
+        (s['i'] + offset, s['cage']): k for (k, s) in enumerate(starts)}
+    if forward:
+        order = range(len(starts) - 1, -1, -1)
+    else:
+        order = range(len(starts))
+    states = []
+    segments = numpy.zeros((len(starts), 2), dtype='int64')
+    joins = numpy.full(len(starts), -1, dtype='int64')
+    for k in order:
+        i = starts[k]['i'] + offset
+        cage = starts[k]['cage']
+        first = len(states)
+        while True:
+            o = origins.get((i, cage), k)
+            if o != k:
+                joins[k] = o
+                break
+            if (forward and i >= n - 1) or (not forward and i < 1):
+                break
+            tube = tubes[i]
+            if tube == cage:
+                cage += 1
+            elif tube == (cage - 1):
+                cage -= 1
+            else:
+                # invalid move
+                break
+            if forward:
+                if i in start_cage and cage != start_cage[i]:
+                    break
+                states.append((i, cage))
+                i += 1
+            else:
+                states.append((i - 1, cage))
+                i -= 1
+        segments[k] = (first, len(states))
+    states = numpy.array(states, dtype='int64').reshape(-1, 2)
+    return states, segments, joins
+
+
 def from_tube_sequence(rfid_reads):
+    """Find tube (board) changes in an animal's rfid reads and trace the
+    implied cage sequence forward and backward from each of them
+
+    returns a list of starts, each a dict with 'i' (read index), 'cage',
+    'start' & 'end' times and for each direction ('forward', 'backward'):
+      - '<direction>_chain': (k, 2) [read index, cage] array of states
+        traced from this start (a view into an array shared by all starts)
+      - '<direction>_join': index of the start whose chain continues this
+        one or None (see chain_states for the full chain)
+    """
     # find first 0->1 or 1->0 or 1->2 or 2->1...?
     # if 0->1, was in cage 1 between, now in cage 2
     #   if next is 0, invalid!
@@ -571,172 +765,327 @@ def from_tube_sequence(rfid_reads):
     #   if next is 0, moved to cage 1
     #   if next is 1, invalid!
     # valid tubes are cage - 1 or cage
-    starts = []
-    start_i = {}
-    n = len(rfid_reads)
-    for i in range(n-1):
-        if abs(rfid_reads[i, 1] - rfid_reads[i+1, 1]) == 1:
-            # moved cages
-            starts.append({
-                'i': i,
-                'cage': max(rfid_reads[i, 1], rfid_reads[i+1, 1]),
-                'start': rfid_reads[i, 0],
-                'end': rfid_reads[i+1, 0],
-                'forward_chain': [],
-                'backward_chain': [],
-            })
-            start_i[i] = starts[-1]
-    # for each start, trace out the sequence of cages
-    for start in starts:
-        i = start['i']
-        cage = start['cage']
-        chain = start['forward_chain']
-        # at start['i'] animal entered start['cage']
-        # trace forward (until next start, or end)
-        i += 1
-        while i < n - 1:
-            r = rfid_reads[i]
-            tube = r[1]
-            if tube == cage:
-                cage += 1
-            elif tube == (cage - 1):
-                cage -= 1
-            else:
-                # invalid move
-                break
-            if i in start_i:
-                if cage != start_i[i]['cage']:
-                    break
-            chain.append((i, cage))
-            i += 1
-        i = start['i']
-        cage = start['cage']
-        chain = start['backward_chain']
-        # trace backward (until previous start, or beginning)
-        while i >= 1:
-            r = rfid_reads[i]
-            tube = r[1]
-            if tube == cage:
-                cage += 1
-            elif tube == cage - 1:
-                cage -= 1
-            else:
-                # invalid move
-                break
-            chain.append((i - 1, cage))
-            i -= 1
+    tubes = rfid_reads[:, consts.BOARD_COLUMN]
+    ci = numpy.where(numpy.abs(numpy.diff(tubes)) == 1)[0]
+    starts = [
+        {
+            'i': i,
+            'cage': max(tubes[i], tubes[i + 1]),
+            'start': rfid_reads[i, consts.TIME_COLUMN],
+            'end': rfid_reads[i + 1, consts.TIME_COLUMN],
+        } for i in ci]
+    # trace the sequence of cages (using python ints, it's a serial walk)
+    tubes = tubes.tolist()
+    for (key, forward) in (('forward', True), ('backward', False)):
+        states, segments, joins = _trace_chains(tubes, starts, forward)
+        for (s, (first, last), join) in zip(starts, segments, joins):
+            s[key + '_chain'] = states[first:last]
+            s[key + '_join'] = None if join == -1 else join
     return starts
 
 
+def chain_states(sequences, si, direction):
+    """All [read index, cage] states of a chain (direction: 'forward' or
+    'backward') from start si including the chains it joins"""
+    chains = []
+    while si is not None:
+        chains.append(sequences[si][direction + '_chain'])
+        si = sequences[si][direction + '_join']
+    if len(chains) == 1:
+        return chains[0]
+    return numpy.vstack(chains)
+
+
+def _chain_reaches(sequences, si, oi, direction):
+    """Does the chain from start si pass through the starting state of
+    start oi. Chains step one read at a time and can't join another chain
+    before passing the neighboring start so only si's own segment is
+    checked (see _trace_chains)"""
+    s = sequences[si]
+    o = sequences[oi]
+    chain = s[direction + '_chain']
+    if direction == 'forward':
+        row = o['i'] - s['i'] - 1
+    else:
+        row = s['i'] - o['i'] - 1
+    return 0 <= row < len(chain) and chain[row, 1] == o['cage']
+
+
+def _covered_segments(sequences, hits, direction):
+    """Which chain segments are part of at least one hit chain, found by
+    pushing hit counts along join pointers (forward chains join later
+    starts, backward chains join earlier starts)"""
+    counts = numpy.asarray(hits, dtype='int64').copy()
+    if direction == 'forward':
+        order = range(len(sequences))
+    else:
+        order = range(len(sequences) - 1, -1, -1)
+    for k in order:
+        j = sequences[k][direction + '_join']
+        if j is not None and counts[k]:
+            counts[j] += counts[k]
+    return counts > 0
+
+
 def merge_sequences(sequences):
-    od = {}
-    hits = 0
-    for si in range(len(sequences)):
-        s = sequences[si]
-        if si != len(sequences) - 1:
-            n = sequences[si + 1]
-            # only count hits
-            if (n['i'], n['cage']) in s['forward_chain']:
-                hits += 1
-                for i in s['forward_chain']:
-                    od[i[0]] = od.get(i[0], []) + [i[1], ]
+    """Merge the chains of all starts (see from_tube_sequence) that reach
+    the neighboring start into a single sequence. Each state of a merged
+    chain is a vote for a cage at a read index, reads with votes for more
+    than one cage are ambiguous. Starts always keep their own cage.
+
+    returns (sequence, reliability) where sequence is a dict of:
+      - 'index': sorted read indices
+      - 'cage': cage for each read index (-1 if ambiguous)
+      - 'ambiguous': bool mask of reads with more than one cage
+    and reliability is the fraction of forward chains that reached the
+    next start
+    """
+    n = len(sequences)
+    forward_hits = numpy.zeros(n, dtype='bool')
+    backward_hits = numpy.zeros(n, dtype='bool')
+    for si in range(n):
+        if si != n - 1:
+            forward_hits[si] = _chain_reaches(
+                sequences, si, si + 1, 'forward')
         if si != 0:
-            p = sequences[si - 1]
-            if (p['i'], p['cage']) in s['backward_chain']:
-                for i in s['backward_chain']:
-                    od[i[0]] = od.get(i[0], []) + [i[1], ]
-    # compute reliability score
-    reliability = hits / float(len(sequences) - 1)
-    for i in od:
-        l = list(set(od[i]))
-        if len(l) == 1:
-            od[i] = l[0]
-        else:
-            od[i] = l
-    for si in sequences:
-        od[si['i']] = si['cage']
-    return od, reliability
+            backward_hits[si] = _chain_reaches(
+                sequences, si, si - 1, 'backward')
+    # only count forward hits
+    reliability = forward_hits.sum() / float(n - 1)
+    chains = []
+    for (d, hits) in (
+            ('forward', forward_hits), ('backward', backward_hits)):
+        covered = _covered_segments(sequences, hits, d)
+        chains.extend([
+            sequences[si][d + '_chain'] for si in numpy.where(covered)[0]])
+    states = numpy.vstack(
+        [numpy.zeros((0, 2), dtype='int64'), ] + chains)
+    start_inds = numpy.array([s['i'] for s in sequences], dtype='int64')
+    start_cages = numpy.array([s['cage'] for s in sequences], dtype='int64')
+    n_reads = max(
+        states[:, 0].max(initial=-1), start_inds.max(initial=-1)) + 1
+    n_cages = max(
+        states[:, 1].max(initial=-1), start_cages.max(initial=-1)) + 1
+    # votes[read index, cage]
+    votes = numpy.zeros((n_reads, n_cages), dtype='bool')
+    votes[states[:, 0], states[:, 1]] = True
+    n_votes = votes.sum(axis=1)
+    cages = numpy.where(n_votes == 1, votes.argmax(axis=1), -1)
+    ambiguous = n_votes > 1
+    cages[start_inds] = start_cages
+    ambiguous[start_inds] = False
+    n_votes[start_inds] = 1
+    index = numpy.where(n_votes > 0)[0]
+    sequence = {
+        'index': index,
+        'cage': cages[index],
+        'ambiguous': ambiguous[index],
+    }
+    return sequence, reliability
 
 
 def merged_sequence_to_occupancy(sequence, reads):
-    # sequence: dict with key = read index, value = cage
+    # sequence: dict of read 'index', 'cage' & 'ambiguous' arrays
     animal = list(set(reads[:, consts.RFID_ID_COLUMN]))
     if len(animal) != 1:
         raise Exception
     animal = animal[0]
-    inds = numpy.array(sorted(sequence.keys()))
+    inds = sequence['index']
     # [start, end, cage, animal, direction?]
-    occupancy = []
     # cage from inds[i] to inds[i+1]
-    for (i, ind) in enumerate(inds[:-1]):
-        c = sequence[ind]
-        if isinstance(c, list):
-            continue
-        st = reads[ind, 0]
-        et = reads[inds[i + 1], 0]
-        occupancy.append([st, et, c, animal, 0])
-    return numpy.array(occupancy)
+    valid = ~sequence['ambiguous'][:-1]
+    st = reads[inds[:-1], consts.TIME_COLUMN][valid]
+    et = reads[inds[1:], consts.TIME_COLUMN][valid]
+    cages = sequence['cage'][:-1][valid]
+    return numpy.column_stack([
+        st, et, cages, numpy.full(len(st), animal),
+        numpy.zeros(len(st), dtype=st.dtype)])
+
+
+def _close_read_runs(times, threshold, boards):
+    """[start, end) rows of runs of reads (sorted by board then time) on
+    the same board less than threshold apart"""
+    close = (numpy.diff(times) < threshold) & (numpy.diff(boards) == 0)
+    edges = numpy.diff(close.astype('i1'), prepend=0, append=0)
+    starts = numpy.where(edges == 1)[0]
+    ends = numpy.where(edges == -1)[0] + 1
+    return starts, ends
+
+
+def multi_animal_event_arrays(rfid_reads, threshold):
+    """Find runs of rfid reads on the same board less than threshold apart
+
+    returns dict of flat arrays with events sorted by start time:
+      - 'times', 'animals': read times and animals of all events
+      - 'offsets': event i is times[offsets[i]:offsets[i + 1]]
+      - 'board': board of each event
+    """
+    reads = numpy.vstack(list(rfid_reads.values()))
+    reads = reads[numpy.lexsort((
+        reads[:, consts.TIME_COLUMN], reads[:, consts.BOARD_COLUMN]))]
+    times = reads[:, consts.TIME_COLUMN]
+    boards = reads[:, consts.BOARD_COLUMN]
+    starts, ends = _close_read_runs(times, threshold, boards)
+    event_boards = boards[starts]
+    # order events by start time (boards in order for ties)
+    order = numpy.argsort(times[starts], kind='stable')
+    starts = starts[order]
+    lengths = ends[order] - starts
+    offsets = numpy.zeros(len(starts) + 1, dtype='int64')
+    numpy.cumsum(lengths, out=offsets[1:])
+    rows = (
+        numpy.arange(offsets[-1]) +
+        numpy.repeat(starts - offsets[:-1], lengths))
+    return {
+        'times': times[rows],
+        'animals': reads[rows, consts.RFID_ID_COLUMN],
+        'offsets': offsets,
+        'board': event_boards[order],
+    }
 
 
 def find_multi_animal_events(rfid_reads, threshold):
-    reads = numpy.vstack(rfid_reads.values())
-    reads = reads[reads[:, consts.TIME_COLUMN].argsort()]
-    boards = numpy.unique(reads[:, consts.BOARD_COLUMN])
-    maes = []
-    for board in boards:
-        br = reads[reads[:, consts.BOARD_COLUMN] == board]
-        starts = numpy.where(
-            numpy.diff(br[:, consts.TIME_COLUMN]) < threshold)[0]
-        n = len(br)
-        used = []
-        for start in starts:
-            if start in used:
-                continue
-            # find all contributing events
-            index = start + 1
-            used.append(start)
-            while index < n:
-                if (
-                        br[index, consts.TIME_COLUMN] -
-                        br[index - 1, consts.TIME_COLUMN] < threshold):
-                    used.append(index)
-                    index += 1
-                else:
-                    break
-            evs = br[start:index]
-            maes.append({
-                'times': evs[:, consts.TIME_COLUMN],
-                'animals': evs[:, consts.RFID_ID_COLUMN],
-                'board': board,
-            })
-    return sorted(maes, key=lambda i: i['times'][0])
+    """Find runs of rfid reads on the same board less than threshold apart
+    (see multi_animal_event_arrays)
+    returns list of dicts with 'times', 'animals' & 'board' sorted by
+    start time"""
+    maes = multi_animal_event_arrays(rfid_reads, threshold)
+    splits = maes['offsets'][1:-1]
+    return [
+        {'times': t, 'animals': a, 'board': b}
+        for (t, a, b) in zip(
+            numpy.split(maes['times'], splits),
+            numpy.split(maes['animals'], splits),
+            maes['board'])]
 
 
-def generate_chase_matrix(multi_animal_events, board=None, animals=None):
-    if board is None:
-        tb = lambda b: True
+def _multi_animal_event_arrays(multi_animal_events):
+    """flat arrays (see multi_animal_event_arrays) from either the flat
+    arrays or a list of multi animal event dicts"""
+    if isinstance(multi_animal_events, dict):
+        return multi_animal_events
+    maes = multi_animal_events
+    offsets = numpy.zeros(len(maes) + 1, dtype='int64')
+    numpy.cumsum([len(e['animals']) for e in maes], out=offsets[1:])
+    if len(maes):
+        times = numpy.concatenate([e['times'] for e in maes])
+        animals = numpy.concatenate([e['animals'] for e in maes])
     else:
-        tb = lambda b: board == b
-    chase_dict = {}
-    for e in multi_animal_events:
-        if not tb(e['board']):
-            continue
-        chaser = e['animals'][-1]
-        chased = e['animals'][:-1][::-1]
-        if chaser not in chase_dict:
-            chase_dict[chaser] = {}
-        for c in chased:
-            if c not in chase_dict[chaser]:
-                chase_dict[chaser][c] = 1
-            else:
-                chase_dict[chaser][c] += 1
+        times = numpy.zeros(0)
+        animals = numpy.zeros(0, dtype='int64')
+    return {
+        'times': times,
+        'animals': animals,
+        'offsets': offsets,
+        'board': numpy.array([e['board'] for e in maes]),
+    }
+
+
+def _chase_pairs(offsets):
+    """(event, chaser row, chased row) for every read in an event but the
+    last (the chaser)"""
+    lengths = numpy.diff(offsets)
+    events = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    rows = numpy.arange(offsets[-1])
+    last = offsets[events + 1] - 1
+    chased = rows != last
+    return events[chased], last[chased], rows[chased]
+
+
+def _association_pairs(offsets):
+    """(event, first row, second row) for every pair of reads in an event
+    with the first read before the second"""
+    lengths = numpy.diff(offsets)
+    events = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    rows = numpy.arange(offsets[-1])
+    # each read pairs with all later reads in the same event
+    n_later = offsets[events + 1] - rows - 1
+    firsts = numpy.repeat(rows, n_later)
+    pair_offsets = numpy.cumsum(n_later) - n_later
+    seconds = (
+        firsts + 1 + numpy.arange(len(firsts)) -
+        numpy.repeat(pair_offsets, n_later))
+    return events[firsts], firsts, seconds
+
+
+interaction_pairs = {
+    'chase': _chase_pairs,
+    'association': _association_pairs,
+}
+
+
+def count_interactions(
+        multi_animal_events, kind='chase', animals=None, board=None,
+        by_board=False, window=None, start=None, count_self=True):
+    """Count pairwise interactions between animals in multi animal events
+    (a list of dicts or flat arrays from multi_animal_event_arrays)
+    kind: 'chase' (last read animal chases all earlier read animals) or
+    'association' (each read animal with every later read animal)
+    animals: animals to count (others are ignored), default all animals
+    board: only count events on this board
+    by_board: count events separately for each board
+    window: count events in time windows of this size (by event start
+    time) from start (default first event start)
+    count_self: count pairs of an animal with itself
+
+    returns counts, animals, boards, window starts
+    counts is [board, window, first animal, second animal] with board and
+    window axes of length 1 if not by_board or window is None
+    (boards & window starts are then None)
+    """
+    maes = _multi_animal_event_arrays(multi_animal_events)
+    events, firsts, seconds = interaction_pairs[kind](maes['offsets'])
+    firsts = maes['animals'][firsts]
+    seconds = maes['animals'][seconds]
+    valid = numpy.ones(len(events), dtype='bool')
+    if board is not None:
+        valid &= maes['board'][events] == board
+    if not count_self:
+        valid &= firsts != seconds
     if animals is None:
-        animals = list(chase_dict.keys())
-        [animals.extend(list(chase_dict[a].keys())) for a in chase_dict]
-        animals = sorted(list(set(animals)))
-    n = len(animals)
-    chase_matrix = numpy.zeros((n, n))
-    for (i, a) in enumerate(animals):
-        for (j, b) in enumerate(animals):
-            chase_matrix[i, j] = chase_dict.get(a, {}).get(b, 0)
-    return chase_matrix, animals
+        animals = numpy.unique(numpy.concatenate(
+            (firsts[valid], seconds[valid])))
+    # map animal ids to dense indices
+    aids = numpy.asarray(animals)
+    n = len(aids)
+    sorter = numpy.argsort(aids, kind='stable')
+    fi = numpy.searchsorted(aids, firsts, sorter=sorter)
+    si = numpy.searchsorted(aids, seconds, sorter=sorter)
+    if n:
+        fi = numpy.minimum(fi, n - 1)
+        si = numpy.minimum(si, n - 1)
+        valid &= (aids[sorter[fi]] == firsts) & (aids[sorter[si]] == seconds)
+        fi = sorter[fi]
+        si = sorter[si]
+    else:
+        valid[:] = False
+    groups = numpy.zeros(len(events), dtype='int64')
+    boards = None
+    n_boards = 1
+    if by_board:
+        boards, bi = numpy.unique(maes['board'], return_inverse=True)
+        n_boards = len(boards)
+        groups += bi[events]
+    window_starts = None
+    n_windows = 1
+    if window is not None:
+        ets = maes['times'][maes['offsets'][:-1]]
+        if start is None:
+            start = ets.min() if len(ets) else 0
+        ewi = numpy.floor_divide(ets - start, window).astype('int64')
+        n_windows = int(ewi.max(initial=-1)) + 1
+        window_starts = start + numpy.arange(n_windows) * window
+        wi = ewi[events]
+        valid &= wi >= 0
+        groups = groups * n_windows + wi
+    flat = (groups[valid] * n + fi[valid]) * n + si[valid]
+    counts = numpy.bincount(flat, minlength=n_boards * n_windows * n * n)
+    return (
+        counts.reshape(n_boards, n_windows, n, n),
+        animals, boards, window_starts)
+
+
+def generate_chase_matrix(multi_animal_events, board=None, animals=None):
+    chase_matrix, animals, _, _ = count_interactions(
+        multi_animal_events, 'chase', animals=animals, board=board)
+    return chase_matrix[0, 0].astype('f8'), list(animals)
@@ -1,68 +1,231 @@
 #!/usr/bin/env python
 
+import json
+
 import numpy
 
 from . import consts
-from . import db
+
+
+touch_sides = (
+    (consts.TOUCH_LEFT, consts.TOUCH_LEFT_COLUMN),
+    (consts.TOUCH_RIGHT, consts.TOUCH_RIGHT_COLUMN),
+)
+
+
+def _group_by_board(tdata):
+    """rows of tdata grouped by board (in time order within each board)
+    returns order, group start offsets, board of each group, group of each
+    grouped row and rank (position in time order) of each row (or None if
+    tdata is already in time order)"""
+    n = len(tdata)
+    times = tdata[:, consts.TIME_COLUMN]
+    boards = tdata[:, consts.BOARD_COLUMN]
+    # board ids are small so (stable) sort them as uint16 (a radix sort)
+    bkey = boards
+    if boards.min() >= 0 and boards.max() < 1 << 16:
+        bkey = boards.astype('u2')
+    if numpy.all(times[1:] >= times[:-1]):
+        # group rows by board keeping time order within each board
+        order = numpy.argsort(bkey, kind='stable')
+        rank = None
+    else:
+        order = numpy.lexsort((times, bkey))
+        # position of each row in time order
+        rank = numpy.empty(n, dtype='int64')
+        rank[numpy.argsort(times, kind='stable')] = numpy.arange(n)
+    sboards = boards[order]
+    starts = numpy.flatnonzero(numpy.diff(sboards, prepend=sboards[0] - 1))
+    groups = numpy.repeat(
+        numpy.arange(len(starts)), numpy.diff(numpy.append(starts, n)))
+    return order, starts, sboards[starts], groups, rank
+
+
+def _grouped_stats(v, starts):
+    """min, max, sum and count for each group of rows
+    v[starts[i]:starts[i + 1]]"""
+    return (
+        numpy.minimum.reduceat(v, starts),
+        numpy.maximum.reduceat(v, starts),
+        numpy.add.reduceat(v, starts, dtype='f8'),
+        numpy.diff(numpy.append(starts, len(v))))
+
+
+def _thresholds(vmin, vmax, vmean, max_ratio_threshold):
+    """threshold (flipped in sign if inverted) and inversion"""
+    t = (vmax - vmin) * max_ratio_threshold + vmin
+    # invert if the threshold is below the mean
+    invert = t < vmean
+    return numpy.where(invert, -t, t), invert
+
+
+def _edges(v, starts, groups, thresholds, invert, previous=None):
+    """rows of v (grouped, see _group_by_board) at which the thresholded
+    state changes and state of every row. The first row of a group is an
+    edge only if it differs from the previous state of the group
+    (previous is -1 for no previous state)"""
+    state = numpy.where(
+        invert[groups], -v > thresholds[groups], v > thresholds[groups])
+    edge = numpy.empty(len(v), dtype='bool')
+    edge[0] = False
+    numpy.not_equal(state[1:], state[:-1], out=edge[1:])
+    if previous is None:
+        edge[starts] = False
+    else:
+        edge[starts] = (previous != -1) & (previous != state[starts])
+    return edge, state
+
+
+def _edge_events(tdata, rows, states, rank):
+    """binary touch events for edge rows of each side in time order (left
+    before right for events at the same time)"""
+    times = tdata[:, consts.TIME_COLUMN]
+    boards = tdata[:, consts.BOARD_COLUMN]
+    # output position of each edge
+    positions = []
+    for ((side, _), r) in zip(touch_sides, rows):
+        positions.append((r if rank is None else rank[r]) * 2 + side)
+    ranks = numpy.empty(sum(len(r) for r in rows), dtype='int64')
+    ranks[numpy.argsort(numpy.concatenate(positions))] = numpy.arange(
+        len(ranks))
+    evs = numpy.empty((len(ranks), tdata.shape[1]), dtype=tdata.dtype)
+    i = 0
+    for ((side, _), r, s) in zip(touch_sides, rows, states):
+        oi = ranks[i:i + len(r)]
+        i += len(r)
+        evs[oi, consts.TIME_COLUMN] = times[r]
+        evs[oi, consts.BOARD_COLUMN] = boards[r]
+        evs[oi, consts.EVENT_COLUMN] = consts.EVENT_TOUCH_BINARY
+        evs[oi, consts.TOUCH_SIDE_COLUMN] = side
+        evs[oi, consts.TOUCH_STATE_COLUMN] = s
+    return evs
 
 
 def binarize(tdata, max_ratio_threshold=0.4):
-    bids = db.all_boards(tdata)
-    r = {}
-    ts = {}
-    # process each board separately
-    for bid in bids:
-        td = db.sel(tdata, board=bid)
-        tl = td[:, consts.TOUCH_LEFT_COLUMN].copy()
-        tr = td[:, consts.TOUCH_RIGHT_COLUMN].copy()
-        
-        # compute thresholds
-        tlt = (tl.ptp() * max_ratio_threshold + tl.min())
-        trt = (tr.ptp() * max_ratio_threshold + tr.min())
-        
-        # invert?
-        if tlt < tl.mean():
-            # invert left
-            tl *= -1
-            tlt *= -1
-        if trt < tr.mean():
-            tr *= -1
-            trt *= -1
-        
-        # save thresholds
-        ts[bid] = (tlt, trt)
-        
-        # find all super-threshold events
-        tdb = td.copy()
-        tdb[:, consts.TOUCH_LEFT_COLUMN] = tl > tlt
-        tdb[:, consts.TOUCH_RIGHT_COLUMN] = tr > trt
-        
-        # find transitions (rising or falling)
-        m = numpy.diff(tdb, axis=0)
-
-        # get left/right board events
-        le = tdb[1:][numpy.abs(m[:, consts.TOUCH_LEFT_COLUMN]) == 1].copy()
-        re = tdb[1:][numpy.abs(m[:, consts.TOUCH_RIGHT_COLUMN]) == 1].copy()
-        
-        # reorganize to [time, board, type, side, high/low]
-        le[:, consts.TOUCH_STATE_COLUMN] = le[:, consts.TOUCH_LEFT_COLUMN]
-        re[:, consts.TOUCH_STATE_COLUMN] = re[:, consts.TOUCH_RIGHT_COLUMN]
-        le[:, consts.TOUCH_SIDE_COLUMN] = consts.TOUCH_LEFT
-        re[:, consts.TOUCH_SIDE_COLUMN] = consts.TOUCH_RIGHT
-        
-        # recombine events
-        r[bid] = numpy.vstack((le, re))
-        
-        # set event type to touch binary
-        r[bid][:, consts.EVENT_COLUMN] = consts.EVENT_TOUCH_BINARY
-        
-        # sort by time
-        #r[bid] = r[bid][numpy.argsort(r[bid][:, 0])]
-
-    # combine events from all boards
-    evs = numpy.vstack(r.values())
-    
-    # sort by time
-    evs = evs[numpy.argsort(evs[:, consts.TIME_COLUMN])]
-    
-    return evs, ts
\ No newline at end of file
+    """Threshold raw touch events from all boards to binary touch events
+    (rising and falling edges), thresholds are computed for each board
+    and side from the range of the raw values (inverted if the threshold
+    is below the mean)
+
+    returns binary touch events in time order (for events at the same
+    time: in input order, left before right) and a dict of
+    thresholds ({board: (left, right)})
+    """
+    if not len(tdata):
+        return tdata[:0].copy(), {}
+    order, starts, bids, groups, rank = _group_by_board(tdata)
+
+    # find edges for each side (only edge rows are kept)
+    rows = []
+    states = []
+    thresholds = []
+    for (_, column) in touch_sides:
+        v = tdata[order, column]
+        vmin, vmax, vsum, vn = _grouped_stats(v, starts)
+        t, invert = _thresholds(vmin, vmax, vsum / vn, max_ratio_threshold)
+        edge, state = _edges(v, starts, groups, t, invert)
+        rows.append(order[edge])
+        states.append(state[edge])
+        thresholds.append(t)
+    ts = {
+        bid: (tlt, trt) for (bid, tlt, trt) in zip(bids, *thresholds)}
+    return _edge_events(tdata, rows, states, rank), ts
+
+
+class TouchBinarizer(object):
+    """Binarize raw touch events chunk by chunk (chunks in time order)
+
+    thresholds: {board: (left, right)} (as returned by binarize, negative
+    thresholds are inverted as raw touch values are positive) to use
+    instead of estimating thresholds. Boards without thresholds use
+    running estimates: as binarize but from the range and mean of all raw
+    values seen so far for the board (so a single chunk is binarized
+    exactly as binarize would).
+
+    The last touch state of each board and side is carried across chunks
+    so an edge at the first event of a chunk is not lost.
+    """
+    def __init__(self, thresholds=None, max_ratio_threshold=0.4):
+        self.fixed_thresholds = dict(thresholds or {})
+        self.max_ratio_threshold = max_ratio_threshold
+        # {board: [(min, max, sum, count) for each side]}
+        self.stats = {}
+        # {board: [last state for each side]}
+        self.states = {}
+
+    def threshold(self, board, side):
+        """current (signed) threshold and inversion for a board and side"""
+        if board in self.fixed_thresholds:
+            t = self.fixed_thresholds[board][side]
+            return t, t < 0
+        vmin, vmax, vsum, vn = self.stats[board][side]
+        return _thresholds(vmin, vmax, vsum / vn, self.max_ratio_threshold)
+
+    @property
+    def thresholds(self):
+        """current thresholds {board: (left, right)}"""
+        bids = set(self.stats) | set(self.fixed_thresholds)
+        return {
+            bid: tuple(
+                self.threshold(bid, side)[0] for (side, _) in touch_sides)
+            for bid in bids}
+
+    def _update_stats(self, bids, side, vmin, vmax, vsum, vn):
+        for (i, bid) in enumerate(bids):
+            if bid in self.fixed_thresholds:
+                continue
+            stats = self.stats.setdefault(bid, [None, None])
+            s = (vmin[i], vmax[i], vsum[i], vn[i])
+            if stats[side] is not None:
+                ps = stats[side]
+                s = (
+                    min(ps[0], s[0]), max(ps[1], s[1]),
+                    ps[2] + s[2], ps[3] + s[3])
+            stats[side] = s
+
+    def binarize(self, tdata):
+        """returns binary touch events (see binarize) for a chunk of raw
+        touch events"""
+        if not len(tdata):
+            return tdata[:0].copy()
+        order, starts, bids, groups, rank = _group_by_board(tdata)
+        ends = numpy.append(starts[1:], len(tdata))
+        rows = []
+        states = []
+        for (side, column) in touch_sides:
+            v = tdata[order, column]
+            self._update_stats(bids, side, *_grouped_stats(v, starts))
+            ti = [self.threshold(bid, side) for bid in bids]
+            t = numpy.array([i[0] for i in ti], dtype='f8')
+            invert = numpy.array([i[1] for i in ti], dtype='bool')
+            previous = numpy.array([
+                self.states.get(bid, (-1, -1))[side] for bid in bids])
+            edge, state = _edges(v, starts, groups, t, invert, previous)
+            rows.append(order[edge])
+            states.append(state[edge])
+            # carry the last state of each board
+            for (bid, s) in zip(bids, state[ends - 1]):
+                self.states.setdefault(bid, [-1, -1])[side] = int(s)
+        return _edge_events(tdata, rows, states, rank)
+
+
+def iter_binarize(chunks, thresholds=None, max_ratio_threshold=0.4):
+    """Yield binary touch events for each chunk of raw touch events
+    (see TouchBinarizer)"""
+    binarizer = TouchBinarizer(thresholds, max_ratio_threshold)
+    for chunk in chunks:
+        yield binarizer.binarize(chunk)
+
+
+def save_thresholds(thresholds, filename):
+    """Save thresholds ({board: (left, right)}) to a json file"""
+    with open(filename, 'w') as f:
+        json.dump(
+            {str(int(b)): [float(t) for t in ts]
+             for (b, ts) in thresholds.items()}, f)
+
+
+def load_thresholds(filename):
+    """Load thresholds saved with save_thresholds"""
+    with open(filename, 'r') as f:
+        return {int(b): tuple(ts) for (b, ts) in json.load(f).items()}
@@ -2,12 +2,13 @@
 
 import sys
 
-import matplotlib.patches
+import matplotlib.collections
 import numpy
 import pylab
 
 from . import consts
 from . import db
+from . import occupancy
 
 
 default_cm = pylab.cm.Paired
@@ -17,9 +18,88 @@ default_cm = pylab.cm.Paired
 #    default_cm = pylab.cm.winter
 
 
+def _pixel_width(ax):
+    return max(int(ax.get_window_extent().width), 1)
+
+
+def decimate_steps(t, y, xlim, n_bins):
+    """Reduce a step signal (sorted times t, values y) to at most ~4 points
+    for each of n_bins bins spanning xlim (the first, min, max and last
+    value in each bin). Points just outside xlim are kept so the steps
+    extend past the edges. Signals with few points are not decimated"""
+    i0 = max(numpy.searchsorted(t, xlim[0], side='right') - 1, 0)
+    i1 = min(numpy.searchsorted(t, xlim[1], side='left') + 1, len(t))
+    t = t[i0:i1]
+    y = y[i0:i1]
+    if len(t) <= 4 * n_bins:
+        return t, y
+    b = numpy.floor(
+        (t - xlim[0]) * (n_bins / float(xlim[1] - xlim[0])))
+    b = numpy.clip(b, -1, n_bins).astype('int64')
+    starts = numpy.flatnonzero(numpy.diff(b, prepend=b[0] - 1))
+    ends = numpy.append(starts[1:], len(t))
+    ts = t[starts]
+    return (
+        numpy.column_stack((ts, ts, ts, t[ends - 1])).ravel(),
+        numpy.column_stack((
+            y[starts], numpy.minimum.reduceat(y, starts),
+            numpy.maximum.reduceat(y, starts), y[ends - 1])).ravel())
+
+
+def decimate_times(t, xlim, n_bins):
+    """Reduce sorted times t to the first time in each of n_bins bins
+    spanning xlim (times outside xlim are dropped)"""
+    t = t[
+        numpy.searchsorted(t, xlim[0], side='left'):
+        numpy.searchsorted(t, xlim[1], side='right')]
+    if len(t) <= n_bins:
+        return t
+    b = numpy.floor(
+        (t - xlim[0]) * (n_bins / float(xlim[1] - xlim[0]))).astype('int64')
+    return t[numpy.flatnonzero(numpy.diff(b, prepend=b[0] - 1))]
+
+
+def _plot_lod_steps(t, y, **kwargs):
+    """Plot steps (where='post') decimated (see decimate_steps) to the
+    pixel width of the axes, re-decimated when the x limits change"""
+    ax = pylab.gca()
+    t = numpy.asarray(t)
+    y = numpy.asarray(y)
+    xlim = (t[0], t[-1]) if t[-1] > t[0] else (t[0], t[0] + 1)
+    line, = ax.step(
+        *decimate_steps(t, y, xlim, _pixel_width(ax)),
+        where='post', **kwargs)
+
+    def on_xlim(ax):
+        line.set_data(*decimate_steps(t, y, ax.get_xlim(), _pixel_width(ax)))
+
+    ax.callbacks.connect('xlim_changed', on_xlim)
+    return line
+
+
+def _plot_lod_vlines(t, ymin, ymax, xlim, **kwargs):
+    """Plot vlines decimated (see decimate_times) to the pixel width of the
+    axes, re-decimated when the x limits change"""
+    ax = pylab.gca()
+    t = numpy.asarray(t)
+    lines = ax.vlines(
+        decimate_times(t, xlim, _pixel_width(ax)), ymin, ymax, **kwargs)
+
+    def on_xlim(ax):
+        ts = decimate_times(t, ax.get_xlim(), _pixel_width(ax))
+        segments = numpy.empty((len(ts), 2, 2))
+        segments[:, :, 0] = ts[:, numpy.newaxis]
+        segments[:, 0, 1] = ymin
+        segments[:, 1, 1] = ymax
+        lines.set_segments(segments)
+
+    ax.callbacks.connect('xlim_changed', on_xlim)
+    return lines
+
+
 def plot_rfid_events(
         events, timerange=None, ymin=-0.5, ymax=0.5, color='k',
-        label=False, animals=None):
+        label=False, animals=None, lod=True):
     rfid = db.sel(events, event='rfid', timerange=timerange, data1=0)
     if len(rfid) == 0:
         return
@@ -27,12 +107,18 @@ def plot_rfid_events(
         animals = numpy.unique(rfid[:, consts.DATA0_COLUMN])
     na = animals.size
     cs = numpy.arange(na) / (na - 1.)
+    xlim = (
+        rfid[:, consts.TIME_COLUMN].min(), rfid[:, consts.TIME_COLUMN].max())
     for (a, c) in zip(animals, cs):
         c = pylab.cm.jet(c)
         ae = db.sel(rfid, data0=a)
         if len(ae) == 0:
             continue
-        pylab.vlines(ae[:, consts.TIME_COLUMN], ymin, ymax, color=c)
+        if lod:
+            _plot_lod_vlines(
+                ae[:, consts.TIME_COLUMN], ymin, ymax, xlim, color=c)
+        else:
+            pylab.vlines(ae[:, consts.TIME_COLUMN], ymin, ymax, color=c)
     return
     rfid = db.sel(events, event='rfid', timerange=timerange)
     if len(rfid) == 0:
@@ -67,10 +153,15 @@ def plot_rfid_events(
 
 def plot_beam_events(
         events, side=None, timerange=None, height=1.0, offset=0.0,
-        color='b'):
+        color='b', lod=True):
     b = db.sel(events, event='beam', data0=side, timerange=timerange)
     if len(b) == 0:
         return
+    if lod:
+        _plot_lod_steps(
+            b[:, consts.TIME_COLUMN],
+            b[:, consts.BEAM_STATE_COLUMN] * height + offset, color=color)
+        return
     pylab.step(
         b[:, consts.TIME_COLUMN],
         b[:, consts.BEAM_STATE_COLUMN] * height + offset,
@@ -79,10 +170,15 @@ def plot_beam_events(
 
 def plot_touch_binary_events(
         events, side=None, timerange=None, height=1.0, offset=0.0,
-        color='g'):
+        color='g', lod=True):
     b = db.sel(events, event='touch_binary', data0=side, timerange=timerange)
     if len(b) == 0:
         return
+    if lod:
+        _plot_lod_steps(
+            b[:, consts.TIME_COLUMN],
+            b[:, consts.TOUCH_STATE_COLUMN] * height + offset, color=color)
+        return
     pylab.step(
         b[:, consts.TIME_COLUMN],
         b[:, consts.TOUCH_STATE_COLUMN] * height + offset,
@@ -148,10 +244,12 @@ def plot_time_in_cage(
     else:
         aids = animals
     if n_cages is None:
-        n_cages = numpy.max(occupancy[:, 2]) + 1
+        n_cages = (
+            int(numpy.max(occupancy[:, 2])) + 1 if len(occupancy) else 0)
 
     if full_time is None:
-        full_time = occupancy[-1, 1] - occupancy[0, 0]
+        full_time = (
+            occupancy[-1, 1] - occupancy[0, 0] if len(occupancy) else 0)
     blabels = [str(cid) for cid in range(n_cages)]
     blabels.append('?')
     # TODO set figure size
@@ -159,22 +257,55 @@ def plot_time_in_cage(
         cm = default_cm
     colors = [cm(bid / float(n_cages - 1)) for bid in range(n_cages)]
     colors.append((0., 0., 0., 0.0))  # add white for unknown
+    tic, _ = db.time_in_cage(occupancy, aids, n_cages)
     for (i, aid) in enumerate(aids):
-        ao = occupancy[occupancy[:, 3] == aid]
-        cts = []
-        for ci in range(n_cages):
-            cts.append(db.sum_range(ao[ao[:, 2] == ci, :2]))
+        cts = list(tic[i])
         # add un-accounted for time
         cts.append(full_time - sum(cts))
         pylab.subplot(1, len(aids), i + 1)
-        pylab.pie(
-            cts, labels=blabels, autopct='%1.1f%%', colors=colors)
+        if sum(cts) > 0:
+            pylab.pie(
+                cts, labels=blabels, autopct='%1.1f%%', colors=colors)
         if as_hex:
             pylab.title(hex(aid))
         else:
             pylab.title(aid)
 
 
+def _bar_collection(left, width, bottom, height, colors, **kwargs):
+    """Add horizontal bars (as barh) as a single PolyCollection to the
+    current axes, returns the collection"""
+    left = numpy.asarray(left, dtype='f8')
+    right = left + width
+    bottom = numpy.broadcast_to(numpy.asarray(bottom, dtype='f8'), left.shape)
+    top = bottom + height
+    verts = numpy.empty((len(left), 4, 2))
+    verts[:, 0] = numpy.column_stack((left, bottom))
+    verts[:, 1] = numpy.column_stack((left, top))
+    verts[:, 2] = numpy.column_stack((right, top))
+    verts[:, 3] = numpy.column_stack((right, bottom))
+    kwargs.setdefault('linewidths', 0)
+    c = matplotlib.collections.PolyCollection(
+        verts, facecolors=colors, **kwargs)
+    if len(left):
+        # like barh, don't add a margin before the first bar
+        c.sticky_edges.x.append(left.min())
+    ax = pylab.gca()
+    ax.add_collection(c)
+    ax.autoscale_view()
+    return c
+
+
+def _animal_indices(animals, aids):
+    """index of each animal in aids (-1 if not in aids)"""
+    aids = numpy.asarray(aids)
+    sorter = numpy.argsort(aids, kind='stable')
+    i = numpy.searchsorted(aids, animals, sorter=sorter)
+    i = numpy.minimum(i, len(aids) - 1)
+    i = sorter[i]
+    return numpy.where(aids[i] == animals, i, -1)
+
+
 def plot_occupancy(
         occupancy, offset=0.0, cm=None, n_cages=None, n_animals=None,
         label_left=None):
@@ -193,29 +324,20 @@ def plot_occupancy(
     # find # of cages
     if n_cages is None:
         n_cages = len(numpy.unique(occupancy[:, 2]))
-    # give each cage a color
-    colors = {
-        cid: cm(cid / float(n_cages - 1.0)) for cid
-        in numpy.arange(n_cages)}
-
     bar_height = 1. / n_aids
-    # plot each animal
+    # add labels
+    _, first = numpy.unique(occupancy[:, 3], return_index=True)
     for (i, aid) in enumerate(aids):
-        # get occupancy for this animal
-        ao = occupancy[occupancy[:, 3] == aid]
-
-        # add label
         ty = i * bar_height + offset
-        tx = ao[0, 0] if label_left is None else label_left
+        tx = occupancy[first[i], 0] if label_left is None else label_left
         pylab.text(tx, ty, str(aid), ha='right', va='center', color='k')
 
-        # barh(bottom, width, height, left, **kwargs)
-        cs = [colors[b] for b in ao[:, 2]]
-        l = numpy.ones_like(ao[:, 1] - ao[:, 0]) * i * bar_height + offset
-        pylab.barh(
-            l, ao[:, 1] - ao[:, 0],
-            bar_height, ao[:, 0], color=cs,
-            linewidth=0)
+    # plot all animals as one collection
+    ai = numpy.searchsorted(aids, occupancy[:, 3])
+    _bar_collection(
+        occupancy[:, 0], occupancy[:, 1] - occupancy[:, 0],
+        ai * bar_height + offset - bar_height / 2., bar_height,
+        cm(occupancy[:, 2] / float(n_cages - 1.0)))
 
     yl = pylab.ylim()
     ylmin = min(yl[0], offset)
@@ -240,24 +362,19 @@ def plot_occupancy2(
         n_aids = len(aids)
     else:
         n_aids = n_animals
-    colors = {
-        aid: cm(v) for (aid, v)
-        in zip(aids, numpy.linspace(0., 1., n_aids))}
+    colors = cm(numpy.linspace(0., 1., n_aids))
 
     # find # of cages
     if n_cages is None:
         n_cages = len(numpy.unique(occupancy[:, 2]))
 
     bar_height = 1. / n_aids
-    # plot each animal
-    for (i, aid) in enumerate(aids):
-        # get occupancy for this animal
-        ao = occupancy[occupancy[:, 3] == aid]
-
-        # barh(bottom, width, height, left, **kwargs)
-        pylab.barh(
-            ao[:, 2] + i * bar_height + offset, ao[:, 1] - ao[:, 0],
-            bar_height, ao[:, 0], color=colors[aid])
+    # plot all animals as one collection
+    ai = numpy.searchsorted(aids, occupancy[:, 3])
+    _bar_collection(
+        occupancy[:, 0], occupancy[:, 1] - occupancy[:, 0],
+        occupancy[:, 2] + ai * bar_height + offset - bar_height / 2.,
+        bar_height, colors[ai])
 
     # draw cage dividers
     for i in range(n_cages + 1):
@@ -345,11 +462,11 @@ def plot_tube_event(e, evs=None, margin=None, offset=0.0):
 
 
 def plot_sequence_chain(s, offset=0, chain_offset=0):
-    for (i, ss) in enumerate(s):
-        for k in ('forward_chain', 'backward_chain'):
-            if not len(ss[k]):
+    for i in range(len(s)):
+        for k in ('forward', 'backward'):
+            arr = occupancy.chain_states(s, i, k)
+            if not len(arr):
                 continue
-            arr = numpy.array(ss[k])
             pylab.plot(arr[:, 0], arr[:, 1] + offset + chain_offset * i)
 
 
@@ -358,19 +475,13 @@ def plot_merged_sequence(
         plot_func=pylab.step, **kwargs):
     if by_time and reads is None:
         raise Exception("Must supply reads if plotting by time")
-    inds = numpy.array(sorted(s.keys()))
+    inds = s['index']
     if by_time:
         xs = reads[inds, 0]
     else:
         xs = inds
-    # ys
-    ys = []
-    for i in inds:
-        if isinstance(s[i], list):
-            ys.append(numpy.nan)
-        else:
-            ys.append(s[i])
-    ys = numpy.array(ys)
+    ys = s['cage'].astype('f8')
+    ys[s['ambiguous']] = numpy.nan
     if plot_func == pylab.step:
         if 'where' not in kwargs:
             kwargs['where'] = 'post'
@@ -409,28 +520,18 @@ def plot_occupancy3(
     else:
         n_aids = n_animals
     dy = 1. / n_aids
-    ainfo = {
-        aid: (cm(i / (n_aids - 1.)), i * dy) for (i, aid)
-        in enumerate(aids)}
 
     # find # of cages
     if n_cages is None:
         n_cages = len(numpy.unique(occupancy[:, 2]))
 
-    bar_height = 1. / n_aids
-    patches = []
-    dy = 1. / n_aids
-    xmin, xmax = occupancy[0][:2]
+    ai = _animal_indices(occupancy[:, 3], aids)
+    o = occupancy[ai != -1]
+    ai = ai[ai != -1]
+    collection = _bar_collection(
+        o[:, 0], o[:, 1] - o[:, 0], o[:, 2] + ai * dy, dy,
+        cm(ai / max(n_aids - 1., 1.)), edgecolors='face', linewidths=1.0)
     ax = pylab.gca()
-    for o in occupancy:
-        (t0, t1, cage, animal) = o[:4]
-        c, ady = ainfo[animal]
-        p = matplotlib.patches.Rectangle(
-            (t0, cage + ady), t1 - t0, dy, color=c)
-        patches.append(p)
-        ax.add_patch(p)
-        xmin = min(xmin, t0)
-        xmax = max(xmax, t1)
-    ax.set_xlim(xmin, xmax)
+    ax.set_xlim(o[:, 0].min(), o[:, 1].max())
     ax.set_ylim(0, n_cages)
-    return patches
\ No newline at end of file
+    return collection
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import os
 import sys
 
 import numpy
@@ -18,6 +19,9 @@ dname = '180131'
 rfid_merge_threshold = None
 output_filename = 'occupancy.csv'
 min_rfid_reads = 100
+# set BLOCKPARTYRFID_CACHE to a directory to cache parsed logs there
+# (e.g. <dname>/.cache), by default logs are parsed every run
+cache_directory = os.environ.get('BLOCKPARTYRFID_CACHE', None)
 
 if len(sys.argv) > 1:
     dname = sys.argv[1]
@@ -26,7 +30,8 @@ if len(sys.argv) > 2:
     rfid_merge_threshold = int(rfid_merge_threshold)
 
 # load in all data
-d = blockpartyrfid.io.load_log_directory(dname)
+d = blockpartyrfid.io.load_log_directory(
+    dname, cache=cache_directory or False)
 
 # filter to just valid rfid tag events
 rd = blockpartyrfid.db.sel(d, event='rfid', data1=0)